@@ -1,29 +1,356 @@
+import atexit
 import base64
+import glob
+import hashlib
+import heapq
+import hmac
+import json
+import math
+import mimetypes
+import os
+import queue
+import random
+import re
+import reprlib
 import secrets
-from datetime import datetime
-from uuid import uuid4
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from datetime import datetime, timedelta, timezone
+from stat import S_ISREG
+from urllib.parse import parse_qs
+from uuid import UUID, uuid4
 
-from flask import Flask, flash, redirect, render_template, request, url_for
+import click
+from flask import (
+    Flask,
+    abort,
+    flash,
+    g,
+    get_flashed_messages,
+    has_app_context,
+    redirect,
+    render_template,
+    request,
+    send_from_directory,
+    session,
+    stream_template,
+    template_rendered,
+    url_for,
+)
+from flask.signals import before_render_template
 from flask_login import LoginManager
-from flask_sqlalchemy import SQLAlchemy
-from slugify import slugify
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
 from sqlalchemy import (
+    Boolean,
     Column,
     DateTime,
+    Float,
+    Index,
+    Integer,
     MetaData,
     String,
     Table,
+    create_engine,
     delete,
+    event,
+    false,
+    func,
+    inspect,
+    literal,
+    or_,
     select,
+    true,
+    union_all,
     update,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateColumn
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(16)
 
-# Database Configuration and Setup
+# Configuration
+# Every key can be overridden with a FLASK_-prefixed environment variable,
+# e.g. FLASK_COMPRESS_LEVEL=9.
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///mydatabase.db'
-db = SQLAlchemy(app)
+# HTML responses smaller than this many bytes are sent uncompressed
+app.config['COMPRESS_MIN_SIZE'] = 1024
+# gzip level (1-9) and brotli quality (0-11) for on-the-fly compression
+app.config['COMPRESS_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 4
+# Compiled template bytecode is kept here; defaults to instance/jinja_cache
+app.config['TEMPLATE_CACHE_DIR'] = None
+# Load every template when the worker starts instead of on first use
+app.config['TEMPLATE_PRELOAD'] = True
+# Maximum number of rendered fragments kept by {% cache %} blocks, and their
+# maximum total size in characters; fragments with inline images can be large
+app.config['FRAGMENT_CACHE_SIZE'] = 2048
+app.config['FRAGMENT_CACHE_CHARS'] = 16 * 1024 * 1024
+# Rows fetched per database round trip and characters sent per chunk when
+# streaming large listings
+app.config['STREAM_BATCH_SIZE'] = 500
+app.config['STREAM_BUFFER_SIZE'] = 16384
+# Freshness of public pages, and how long caches may keep serving a stale
+# copy while they revalidate it in the background
+app.config['CACHE_PUBLIC_MAX_AGE'] = 60
+app.config['CACHE_STALE_WHILE_REVALIDATE'] = 600
+# Client addresses allowed to scrape /metrics
+app.config['METRICS_ALLOWED_ADDRS'] = ['127.0.0.1', '::1']
+# Statements slower than this are logged together with their parameters;
+# executemany batches are not
+app.config['SQL_SLOW_QUERY_MS'] = 100
+# Run EXPLAIN QUERY PLAN on the queries of SQL_EXPLAIN_ENDPOINTS and warn
+# about full table scans; None means only in debug mode
+app.config['SQL_EXPLAIN'] = None
+app.config['SQL_EXPLAIN_ENDPOINTS'] = [
+    'home', 'display_projects', 'show_project', 'contact', 'cms_inbox',
+    'view_message', 'view_project', 'edit_project'
+]
+# Warn when a single statement runs this many times in one request (N+1)
+app.config['SQL_REPEAT_THRESHOLD'] = 20
+# Key for signing profiling requests; profiling is disabled without one.
+# Tokens expire after PROFILE_TOKEN_SECONDS unless issued with another
+# lifetime.
+app.config['PROFILER_SECRET'] = None
+app.config['PROFILE_TOKEN_SECONDS'] = 3600
+# Profiles are written here; defaults to instance/profiles. Only the newest
+# PROFILE_MAX_FILES are kept.
+app.config['PROFILE_DIR'] = None
+app.config['PROFILE_MAX_FILES'] = 100
+# JSON-lines access log written by a background thread; defaults to
+# instance/access.log. All workers append to the same file, which is rotated
+# by an external tool such as logrotate (moved, not copied and truncated);
+# writers reopen it once it has been moved. Entries are dropped rather than
+# blocking requests once ACCESS_LOG_QUEUE_SIZE are waiting
+app.config['ACCESS_LOG'] = True
+app.config['ACCESS_LOG_FILE'] = None
+app.config['ACCESS_LOG_QUEUE_SIZE'] = 10000
+# Queue contact form submissions for a background writer that inserts them
+# in one transaction per CONTACT_BATCH_MS or CONTACT_BATCH_SIZE rows. Each
+# request still waits until its batch has committed, for at most
+# CONTACT_WRITE_TIMEOUT seconds.
+app.config['CONTACT_WRITE_BEHIND'] = False
+app.config['CONTACT_BATCH_MS'] = 5
+app.config['CONTACT_BATCH_SIZE'] = 200
+app.config['CONTACT_WRITE_TIMEOUT'] = 10
+# Contact messages that cannot get the SQLite write lock within
+# CONTACT_LOCK_TIMEOUT seconds are appended to a journal (defaults to
+# contact_spool.jsonl next to the database, as the journal belongs to it) and
+# replayed every CONTACT_SPOOL_INTERVAL seconds
+app.config['CONTACT_SPOOL'] = True
+app.config['CONTACT_SPOOL_FILE'] = None
+app.config['CONTACT_LOCK_TIMEOUT'] = 0.5
+app.config['CONTACT_SPOOL_INTERVAL'] = 5
+# Identical messages (same email, subject and body) posted within the same
+# window of this many minutes are stored once; None disables the check
+app.config['CONTACT_DUPLICATE_WINDOW_MINUTES'] = 10
+# Email NOTIFY_EMAIL about new contact messages. Messages are queued in the
+# notification_outbox table in the same transaction as the insert and sent
+# by a background worker, which polls every NOTIFY_INTERVAL seconds and
+# sends one digest when at least NOTIFY_DIGEST_THRESHOLD are waiting. Failed
+# sends are retried after NOTIFY_RETRY_SECONDS, doubling up to an hour, and
+# parked after NOTIFY_MAX_ATTEMPTS. Point NOTIFY_SMTP_HOST/PORT at a local
+# stand-in (e.g. `python -m aiosmtpd -n -l localhost:8025`) to try it out.
+app.config['NOTIFY_EMAIL'] = None
+app.config['NOTIFY_FROM'] = 'noreply@localhost'
+app.config['NOTIFY_SMTP_HOST'] = 'localhost'
+app.config['NOTIFY_SMTP_PORT'] = 25
+app.config['NOTIFY_SMTP_STARTTLS'] = False
+app.config['NOTIFY_SMTP_USERNAME'] = None
+app.config['NOTIFY_SMTP_PASSWORD'] = None
+app.config['NOTIFY_INTERVAL'] = 5
+app.config['NOTIFY_DIGEST_THRESHOLD'] = 5
+app.config['NOTIFY_RETRY_SECONDS'] = 30
+app.config['NOTIFY_MAX_ATTEMPTS'] = 10
+# Webhook endpoints notified of content and inbox events, e.g.
+#   [{"url": "https://example.com/hook", "secret": "...",
+#     "events": ["project.created", "message.created"]}]
+# Without "events" an endpoint receives project.created, project.updated,
+# project.deleted and message.created. Events are POSTed as JSON in batches
+# of up to WEBHOOK_BATCH_SIZE collected over WEBHOOK_BATCH_MS, by a pool of
+# WEBHOOK_WORKERS threads with at most WEBHOOK_CONCURRENCY requests per
+# endpoint, and retried up to WEBHOOK_MAX_ATTEMPTS times. Events are kept in
+# memory only; beyond WEBHOOK_QUEUE_SIZE waiting they are dropped.
+app.config['WEBHOOKS'] = []
+app.config['WEBHOOK_TIMEOUT'] = 5
+app.config['WEBHOOK_BATCH_MS'] = 200
+app.config['WEBHOOK_BATCH_SIZE'] = 100
+app.config['WEBHOOK_WORKERS'] = 4
+app.config['WEBHOOK_CONCURRENCY'] = 2
+app.config['WEBHOOK_MAX_ATTEMPTS'] = 5
+app.config['WEBHOOK_QUEUE_SIZE'] = 10000
+# Token bucket per client address for contact form posts: CONTACT_RATE_BURST
+# posts at once, refilled at CONTACT_RATE_PER_MINUTE. 'memory' keeps the
+# buckets per process, 'sqlite' shares them between workers through
+# CONTACT_RATE_LIMIT_DB (defaults to instance/rate_limits.db); None disables
+app.config['CONTACT_RATE_LIMIT'] = 'memory'
+app.config['CONTACT_RATE_BURST'] = 5
+app.config['CONTACT_RATE_PER_MINUTE'] = 2
+app.config['CONTACT_RATE_LIMIT_DB'] = None
+# Contact messages older than RETENTION_MONTHS whole months are moved out of
+# the contact_messages table into one SQLite file per month in ARCHIVE_DIR
+# (defaults to an archive directory next to the database) by the archive
+# maintenance task or `flask archive-messages`; None keeps every message in
+# the table. Archives are searched by the CMS, at most ARCHIVE_SEARCH_LIMIT
+# messages per search.
+app.config['RETENTION_MONTHS'] = None
+app.config['ARCHIVE_DIR'] = None
+app.config['ARCHIVE_SEARCH_LIMIT'] = 200
+# Database maintenance on a timetable. MAINTENANCE_SCHEDULE maps each task to
+# its interval in seconds; None disables a task. One worker at a time runs
+# them: it is elected through a lease row that it renews every
+# MAINTENANCE_CHECK_SECONDS and that lapses after MAINTENANCE_LEASE_SECONDS if
+# the worker dies. Tasks are put off while the elected worker is handling
+# more than MAINTENANCE_MAX_IN_FLIGHT requests. incremental_vacuum only frees
+# pages in databases created with auto_vacuum = INCREMENTAL, which init_db
+# sets on new databases; older ones need a one-off VACUUM after setting it.
+app.config['MAINTENANCE'] = True
+# Due tasks run in this order, so that pages freed by archive and cleanup
+# are vacuumed and the statistics describe what is left
+app.config['MAINTENANCE_SCHEDULE'] = {
+    'archive': 86400,
+    'cleanup': 3600,
+    'analyze': 86400,
+    'vacuum': 86400,
+    'checkpoint': 600,
+}
+app.config['MAINTENANCE_CHECK_SECONDS'] = 60
+app.config['MAINTENANCE_LEASE_SECONDS'] = 300
+app.config['MAINTENANCE_MAX_IN_FLIGHT'] = 4
+app.config['MAINTENANCE_VACUUM_PAGES'] = 1000
+app.config['MAINTENANCE_HISTORY_DAYS'] = 30
+# Number of reverse proxies whose X-Forwarded-For header is trusted for the
+# client address
+app.config['PROXY_FIX_X_FOR'] = 0
+app.config.from_prefixed_env()
+
+# Templates
+class FragmentCache:
+  # Least-recently-used store of rendered template fragments
+
+  def __init__(self, max_size, max_chars):
+    self.max_size = max_size
+    self.max_chars = max_chars
+    self.chars = 0
+    self.fragments = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get_or_render(self, key, render):
+    with self.lock:
+      fragment = self.fragments.get(key)
+      if fragment is not None:
+        self.fragments.move_to_end(key)
+    if fragment is not None:
+      metrics.inc('cache_requests_total', cache='fragment', result='hit')
+      if has_app_context() and 'fragment_hits' in g:
+        g.fragment_hits += 1
+      return fragment
+
+    metrics.inc('cache_requests_total', cache='fragment', result='miss')
+    if has_app_context() and 'fragment_misses' in g:
+      g.fragment_misses += 1
+    fragment = render()
+    if len(fragment) > self.max_chars:
+      return fragment
+    with self.lock:
+      previous = self.fragments.pop(key, None)
+      if previous is not None:
+        self.chars -= len(previous)
+      self.fragments[key] = fragment
+      self.chars += len(fragment)
+      while (len(self.fragments) > self.max_size
+             or self.chars > self.max_chars):
+        _, evicted = self.fragments.popitem(last=False)
+        self.chars -= len(evicted)
+    return fragment
+
+
+fragment_cache = FragmentCache(app.config['FRAGMENT_CACHE_SIZE'],
+                               app.config['FRAGMENT_CACHE_CHARS'])
+
+
+class FragmentCacheExtension(Extension):
+  # {% cache 'name', key, version %}...{% endcache %} renders the body once
+  # per distinct set of key values and reuses it afterwards
+  tags = {'cache'}
+
+  def parse(self, parser):
+    lineno = next(parser.stream).lineno
+    key_parts = [parser.parse_expression()]
+    while parser.stream.skip_if('comma'):
+      key_parts.append(parser.parse_expression())
+    body = parser.parse_statements(('name:endcache', ), drop_needle=True)
+    call = self.call_method('_render_cached', [nodes.Tuple(key_parts, 'load')])
+    return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+  def _render_cached(self, key, caller):
+    return fragment_cache.get_or_render(key, caller)
+
+
+template_cache_dir = (app.config['TEMPLATE_CACHE_DIR']
+                      or os.path.join(app.instance_path, 'jinja_cache'))
+os.makedirs(template_cache_dir, exist_ok=True)
+app.jinja_options = {
+    **app.jinja_options,
+    'bytecode_cache': FileSystemBytecodeCache(template_cache_dir),
+    'extensions': [FragmentCacheExtension],
+}
+
+# Database Configuration and Setup
+# Only SQLAlchemy Core is used, so this stands in for Flask-SQLAlchemy,
+# whose import pulls in the whole ORM and was the largest part of `import
+# app`. As there, relative SQLite paths are under the instance folder and
+# db.session is one connection per app context, closed on teardown.
+class Database:
+
+  def __init__(self, app):
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    options = {}
+    if url.database in (None, '', ':memory:'):
+      options['poolclass'] = StaticPool
+      options['connect_args'] = {'check_same_thread': False}
+    elif not os.path.isabs(url.database):
+      os.makedirs(app.instance_path, exist_ok=True)
+      url = url.set(database=os.path.join(app.instance_path, url.database))
+    self.engine = create_engine(url, **options)
+    app.teardown_appcontext(self.close_session)
+
+  @property
+  def session(self):
+    if 'db_connection' not in g:
+      g.db_connection = self.engine.connect()
+    return g.db_connection
+
+  def close_session(self, _exc):
+    connection = g.pop('db_connection', None)
+    if connection is not None:
+      connection.close()
+
+
+db = Database(app)
 
 metadata = MetaData()
 
@@ -31,7 +358,8 @@ metadata = MetaData()
 projects_table = Table('projects', metadata,
                        Column('slug', String, primary_key=True),
                        Column('title', String), Column('description', String),
-                       Column('image', String))
+                       Column('image', String),
+                       Column('version', Integer, server_default='1'))
 
 # Contact Messages
 contact_messages_table = Table('contact_messages', metadata,
@@ -41,20 +369,424 @@ contact_messages_table = Table('contact_messages', metadata,
                                Column('email', String),
                                Column('subject', String),
                                Column('message', String),
-                               Column('timestamp', DateTime))
+                               Column('timestamp', DateTime),
+                               Column('idempotency_key', String),
+                               Column('content_hash', String),
+                               Column('is_read',
+                                      Boolean,
+                                      nullable=False,
+                                      server_default=false()))
+Index('ix_contact_messages_timestamp', contact_messages_table.c.timestamp)
+# Only unread messages are indexed, so the index stays as small as the
+# backlog of new mail
+Index('ix_contact_messages_unread',
+      contact_messages_table.c.timestamp,
+      sqlite_where=contact_messages_table.c.is_read == false())
+# Double posts are dropped by INSERT OR IGNORE against these
+Index('ix_contact_messages_idempotency_key',
+      contact_messages_table.c.idempotency_key,
+      unique=True)
+Index('ix_contact_messages_content_hash',
+      contact_messages_table.c.content_hash,
+      unique=True)
+
+# Message Counters
+# Running totals over contact_messages, kept current by the triggers below so
+# that reading one never needs a COUNT over the table
+message_counters_table = Table(
+    'message_counters', metadata, Column('name', String, primary_key=True),
+    Column('value', Integer, nullable=False))
+
+MESSAGE_COUNTER_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS contact_messages_unread_insert
+    AFTER INSERT ON contact_messages WHEN NOT NEW.is_read BEGIN
+      UPDATE message_counters SET value = value + 1 WHERE name = 'unread';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS contact_messages_unread_delete
+    AFTER DELETE ON contact_messages WHEN NOT OLD.is_read BEGIN
+      UPDATE message_counters SET value = value - 1 WHERE name = 'unread';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS contact_messages_unread_update
+    AFTER UPDATE OF is_read ON contact_messages
+    WHEN OLD.is_read IS NOT NEW.is_read BEGIN
+      UPDATE message_counters
+      SET value = value + CASE WHEN NEW.is_read THEN -1 ELSE 1 END
+      WHERE name = 'unread';
+    END""",
+]
+
+# Message Archive
+# Layout of the monthly archive files, which are attached to a connection as
+# the "archive" schema. The deduplication columns are only needed on insert.
+archive_metadata = MetaData()
+archived_messages_table = Table('contact_messages',
+                                archive_metadata,
+                                Column('id', String, primary_key=True),
+                                Column('first_name', String),
+                                Column('last_name', String),
+                                Column('email', String),
+                                Column('subject', String),
+                                Column('message', String),
+                                Column('timestamp', DateTime),
+                                Column('is_read',
+                                       Boolean,
+                                       nullable=False,
+                                       server_default=false()),
+                                schema='archive')
+Index('ix_archived_messages_timestamp', archived_messages_table.c.timestamp)
+
+# Notification Outbox
+# A row per contact message still to be emailed; it is deleted once sent.
+# next_attempt is NULL for rows that ran out of attempts
+notification_outbox_table = Table(
+    'notification_outbox', metadata, Column('id', Integer, primary_key=True),
+    Column('message_id', String),
+    Column('attempts', Integer, nullable=False, server_default='0'),
+    Column('next_attempt', DateTime), Column('last_error', String))
+Index('ix_notification_outbox_next_attempt',
+      notification_outbox_table.c.next_attempt)
+# A message is queued at most once; a replayed insert is dropped by INSERT OR
+# IGNORE against this
+Index('ix_notification_outbox_message_id',
+      notification_outbox_table.c.message_id,
+      unique=True)
+
+# Maintenance
+# The lease row names the worker currently allowed to run maintenance, and
+# every run is recorded with its duration
+maintenance_lease_table = Table('maintenance_lease', metadata,
+                                Column('name', String, primary_key=True),
+                                Column('owner', String, nullable=False),
+                                Column('expires', DateTime, nullable=False))
+maintenance_runs_table = Table('maintenance_runs', metadata,
+                               Column('id', Integer, primary_key=True),
+                               Column('task', String, nullable=False),
+                               Column('owner', String),
+                               Column('started', DateTime, nullable=False),
+                               Column('duration_seconds', Float),
+                               Column('status', String),
+                               Column('detail', String))
+Index('ix_maintenance_runs_task_started', maintenance_runs_table.c.task,
+      maintenance_runs_table.c.started)
 
 # Session Management
 login_manager = LoginManager()
 login_manager.init_app(app)
 
 
+@login_manager.user_loader
+def load_user(_user_id):
+  # There are no user accounts yet; Flask-Login refuses to render templates
+  # without a loader
+  return None
+
+
+# Metrics
+class MetricsRegistry:
+  # Counters, gauges and histograms exported in the Prometheus text format.
+  # Every thread writes to its own shard without locking; the lock is only
+  # taken when a thread creates its shard and when a scrape sums the shards.
+
+  def __init__(self):
+    self.definitions = {}
+    self.callbacks = {}
+    self.local = threading.local()
+    self.shards = []
+    self.retired = {}
+    self.lock = threading.Lock()
+
+  def counter(self, name, help_text):
+    self.definitions[name] = ('counter', help_text, None)
+
+  def gauge(self, name, help_text, callback=None):
+    # A callback gauge is read at scrape time and returns either a number or
+    # a dict mapping label tuples to numbers
+    self.definitions[name] = ('gauge', help_text, None)
+    if callback is not None:
+      self.callbacks[name] = callback
+
+  def histogram(self, name, help_text, buckets):
+    self.definitions[name] = ('histogram', help_text, tuple(buckets))
+
+  def _shard(self):
+    try:
+      return self.local.shard
+    except AttributeError:
+      shard = self.local.shard = {}
+      with self.lock:
+        # Thread-per-request servers start a thread for every request, so
+        # finished threads are folded away here too, not only on a scrape
+        self._retire_finished()
+        self.shards.append((threading.current_thread(), shard))
+      return shard
+
+  def _retire_finished(self):
+    # Folds the shards of finished threads into one; needs self.lock
+    alive = []
+    for thread, shard in self.shards:
+      if thread.is_alive():
+        alive.append((thread, shard))
+      else:
+        for key, value in shard.items():
+          merge_metric(self.retired, key, value)
+    self.shards = alive
+
+  def inc(self, name, value=1, **labels):
+    shard = self._shard()
+    key = (name, tuple(sorted(labels.items())))
+    shard[key] = shard.get(key, 0) + value
+
+  def dec(self, name, value=1, **labels):
+    self.inc(name, -value, **labels)
+
+  def observe(self, name, value, **labels):
+    buckets = self.definitions[name][2]
+    shard = self._shard()
+    key = (name, tuple(sorted(labels.items())))
+    counts = shard.get(key)
+    if counts is None:
+      # One slot per bucket plus +Inf, then the sum
+      counts = shard[key] = [0] * (len(buckets) + 2)
+    counts[bisect_left(buckets, value)] += 1
+    counts[-1] += value
+
+  def collect(self):
+    totals = {}
+    with self.lock:
+      self._retire_finished()
+      for key, value in self.retired.items():
+        merge_metric(totals, key, value)
+      for _, shard in self.shards:
+        for key, value in dict(shard).items():
+          merge_metric(totals, key,
+                       list(value) if isinstance(value, list) else value)
+
+    for name, callback in self.callbacks.items():
+      value = callback()
+      if not isinstance(value, dict):
+        value = {(): value}
+      for labels, v in value.items():
+        totals[(name, labels)] = v
+    return totals
+
+  def get(self, name, **labels):
+    return self.collect().get((name, tuple(sorted(labels.items()))), 0)
+
+  def render(self):
+    totals = self.collect()
+    lines = []
+    for name, (kind, help_text, buckets) in sorted(self.definitions.items()):
+      lines.append(f"# HELP {name} {help_text}")
+      lines.append(f"# TYPE {name} {kind}")
+      series = sorted((labels, value) for (metric, labels), value in
+                      totals.items() if metric == name)
+      for labels, value in series:
+        if kind != 'histogram':
+          lines.append(f"{name}{format_labels(labels)} {value}")
+          continue
+        cumulative = 0
+        for bound, count in zip(buckets + ('+Inf', ), value[:-1],
+                                strict=True):
+          cumulative += count
+          bucket_labels = labels + (('le', str(bound)), )
+          lines.append(
+              f"{name}_bucket{format_labels(bucket_labels)} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+        lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+def merge_metric(into, key, value):
+  # Adds a counter or gauge value, or a histogram's bucket counts, into a dict
+  if isinstance(value, list):
+    current = into.setdefault(key, [0] * len(value))
+    for i, v in enumerate(value):
+      current[i] += v
+  else:
+    into[key] = into.get(key, 0) + value
+
+
+def format_labels(labels):
+  if not labels:
+    return ''
+  pairs = []
+  for key, value in labels:
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+    pairs.append(f'{key}="{value}"')
+  return '{' + ','.join(pairs) + '}'
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+metrics = MetricsRegistry()
+metrics.counter('http_requests_total',
+                'Requests handled, by endpoint, method and status')
+metrics.gauge('http_requests_in_flight', 'Requests currently being handled')
+metrics.histogram('http_request_duration_seconds',
+                  'Total handler time per request', LATENCY_BUCKETS)
+metrics.histogram('http_request_db_seconds',
+                  'Database time per request', LATENCY_BUCKETS)
+metrics.histogram('http_request_template_seconds',
+                  'Template render time per request', LATENCY_BUCKETS)
+metrics.histogram('http_response_size_bytes',
+                  'Response body size, counted as streamed bodies are sent',
+                  SIZE_BUCKETS)
+metrics.counter('http_upload_bytes_total', 'Request body bytes received')
+metrics.counter('http_compressed_responses_total',
+                'Responses compressed on the fly')
+metrics.counter('http_precompressed_responses_total',
+                'Static files served from a precompressed variant')
+metrics.counter('http_compression_input_bytes_total',
+                'Bytes before on-the-fly compression')
+metrics.counter('http_compression_output_bytes_total',
+                'Bytes after on-the-fly compression')
+metrics.counter('db_queries_total', 'SQL statements executed, by verb')
+metrics.histogram('db_query_duration_seconds', 'SQL statement duration',
+                  QUERY_BUCKETS)
+metrics.counter('cache_requests_total', 'Cache lookups, by cache and result')
+metrics.counter('access_log_dropped_total',
+                'Access log entries dropped because the queue was full')
+metrics.gauge(
+    'contact_write_queue_depth',
+    'Contact submissions waiting for the background writer',
+    callback=lambda: contact_writer.queue.qsize() if contact_writer else 0)
+metrics.counter('contact_spooled_total',
+                'Contact messages journaled because the database was locked')
+metrics.counter('contact_spool_replayed_total',
+                'Journaled contact messages replayed into the database')
+metrics.counter('notifications_sent_total',
+                'Notification emails sent, by kind (single or digest)')
+metrics.counter('notification_failures_total',
+                'Contact messages whose notification failed to send')
+metrics.counter('webhook_events_total',
+                'Webhook events, by result (delivered, failed or dropped)')
+metrics.counter('webhook_requests_total',
+                'Webhook deliveries attempted, by endpoint and outcome')
+metrics.gauge(
+    'webhook_queue_depth',
+    'Webhook events waiting for delivery',
+    callback=lambda: webhooks.queued if webhooks else 0)
+metrics.counter('http_rate_limited_total',
+                'Requests rejected by the rate limiter, by endpoint')
+metrics.histogram('contact_write_batch_size',
+                  'Contact submissions committed per transaction',
+                  (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+metrics.counter('maintenance_runs_total',
+                'Maintenance task runs, by task and status')
+metrics.histogram('maintenance_run_duration_seconds',
+                  'Time taken by a maintenance task run, by task',
+                  (0.01, 0.1, 1, 10, 60, 300, 1800))
+metrics.counter('maintenance_deferred_total',
+                'Maintenance checks put off because of request load')
+metrics.gauge(
+    'maintenance_leader',
+    'Whether this process holds the maintenance lease',
+    callback=lambda: int(maintenance.leader) if maintenance else 0)
+
+
+def migrate_schema(connection):
+  # create_all only creates missing tables, so add any columns that were
+  # introduced after a table was first created
+  inspector = inspect(connection)
+  for table in metadata.sorted_tables:
+    if not inspector.has_table(table.name):
+      continue
+    existing = {column['name'] for column in inspector.get_columns(table.name)}
+    for column in table.columns:
+      if column.name not in existing:
+        column_ddl = CreateColumn(column).compile(dialect=connection.dialect)
+        connection.exec_driver_sql(
+            f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}")
+    for index in table.indexes:
+      index.create(connection, checkfirst=True)
+
+
+def drop_duplicate_notifications(connection):
+  # Outboxes from before the unique message_id index can hold a message more
+  # than once, which would keep the index from being created
+  outbox = notification_outbox_table.c
+  connection.execute(
+      delete(notification_outbox_table).where(
+          outbox.id.not_in(
+              select(func.min(outbox.id)).group_by(outbox.message_id))))
+
+
+def create_message_counters(connection):
+  # The triggers go in first: until the counter row exists they update
+  # nothing, and the single INSERT ... SELECT then counts every row written
+  # before it, so no message is missed or counted twice
+  for trigger in MESSAGE_COUNTER_TRIGGERS:
+    connection.exec_driver_sql(trigger)
+  counter = message_counters_table.c
+  exists = connection.execute(
+      select(counter.name).where(counter.name == 'unread')).first()
+  if exists is None:
+    messages = contact_messages_table.c
+    connection.execute(message_counters_table.insert().prefix_with(
+        'OR IGNORE').from_select(
+            ['name', 'value'],
+            select(literal('unread'), func.count()).where(
+                messages.is_read == false())))
+
+
+db_init_lock = threading.Lock()
+db_initialized = False
+
+
+def init_db():
+  global db_initialized
+  with db.engine.begin() as connection:
+    if not inspect(connection).get_table_names():
+      # Only takes effect before the first table is created
+      connection.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+    # Persistent, so this only changes anything once per database. Readers
+    # (such as a streamed page still being downloaded) then no longer block
+    # commits, and the checkpoint task has a log to checkpoint.
+    connection.exec_driver_sql('PRAGMA journal_mode = WAL')
+    metadata.create_all(connection)
+    drop_duplicate_notifications(connection)
+    migrate_schema(connection)
+    create_message_counters(connection)
+  db_initialized = True
+
+
+@app.before_request
+def ensure_db():
+  # The schema is checked once per process, on its first request, so that
+  # importing the app stays cheap and every server (not only __main__)
+  # creates missing tables
+  if db_initialized:
+    return
+  with db_init_lock:
+    if not db_initialized:
+      init_db()
+
+
+@app.cli.command('init-db')
+def init_db_command():
+  """Create missing tables and columns."""
+  init_db()
+  click.echo('Database initialised')
+
+
 # Utility Functions
 def generate_slug(title):
+  from slugify import slugify
+
   slug_base = slugify(title)
   counter = 1
   new_slug = slug_base
-  projects = db.session.execute(projects_table.select()).fetchall()
-  while new_slug in projects:
+  # The base slug and its numbered variants ("base-1", "base-2", ...) sort
+  # between "base-" and "base.", so this is a primary key range lookup
+  slug = projects_table.c.slug
+  stmt = select(slug).where(
+      or_(slug == slug_base,
+          (slug > f"{slug_base}-") & (slug < f"{slug_base}.")))
+  taken = set(db.session.execute(stmt).scalars())
+  while new_slug in taken:
     new_slug = f"{slug_base}-{counter}"
     counter += 1
   return new_slug
@@ -75,20 +807,94 @@ def format_date(date):
     return date.strftime("%d/%m/%Y")
 
 
+def project_from_row(row):
+  return {
+      'title': row.title,
+      'description': row.description,
+      'image': row.image,
+      'version': row.version
+  }
+
+
+def iter_projects():
+  stmt = projects_table.select().execution_options(
+      yield_per=app.config['STREAM_BATCH_SIZE'], full_scan=True)
+  for row in db.session.execute(stmt):
+    yield row.slug, project_from_row(row)
+
+
+def get_project(slug):
+  stmt = projects_table.select().where(projects_table.c.slug == slug)
+  row = db.session.execute(stmt).first()
+  if row is None:
+    return None
+  return project_from_row(row)
+
+
 def get_projects():
-  results = db.session.execute(projects_table.select()).fetchall()
-  projects = {}
-  for row in results:
-    slug, title, description, image = row
-    project_data = {'title': title, 'description': description, 'image': image}
-    projects[slug] = project_data
-  return projects
-
-
-def get_contact_messages():
-  results = db.session.execute(contact_messages_table.select()).fetchall()
-  messages = []
-  for row in results:
+  return dict(iter_projects())
+
+
+def new_content_version():
+  # Nanosecond timestamp, so a project recreated under the same slug never
+  # reuses the version of a cached fragment
+  return time.time_ns()
+
+
+INBOX_FILTERS = ('sender', 'subject', 'date_from', 'date_to', 'status')
+
+
+def inbox_filters(values):
+  # The inbox filter fields that were filled in, from a query string or form
+  return {
+      name: values.get(name, '').strip()
+      for name in INBOX_FILTERS
+      if values.get(name, '').strip()
+  }
+
+
+def parse_filter_date(value):
+  try:
+    return datetime.strptime(value, '%Y-%m-%d')
+  except ValueError:
+    return None
+
+
+def contact_message_conditions(filters, table=contact_messages_table):
+  # WHERE clauses for inbox_filters() on the inbox or an archive; the dates
+  # are inclusive days and unparseable ones are ignored
+  messages = table.c
+  conditions = []
+  if 'sender' in filters:
+    sender = filters['sender']
+    conditions.append(
+        or_(messages.email.icontains(sender, autoescape=True),
+            (messages.first_name + ' ' + messages.last_name).icontains(
+                sender, autoescape=True)))
+  if 'subject' in filters:
+    conditions.append(
+        messages.subject.icontains(filters['subject'], autoescape=True))
+  date_from = parse_filter_date(filters.get('date_from', ''))
+  if date_from is not None:
+    conditions.append(messages.timestamp >= date_from)
+  date_to = parse_filter_date(filters.get('date_to', ''))
+  if date_to is not None:
+    conditions.append(messages.timestamp < date_to + timedelta(days=1))
+  # Compared with a literal rather than a parameter, which SQLite needs to
+  # match the partial index on unread messages
+  if filters.get('status') == 'unread':
+    conditions.append(messages.is_read == false())
+  elif filters.get('status') == 'read':
+    conditions.append(messages.is_read == true())
+  return conditions
+
+
+def iter_contact_messages(conditions=()):
+  # Newest first, fetched in batches so the inbox can be streamed
+  stmt = select(contact_messages_table).where(*conditions).order_by(
+      contact_messages_table.c.timestamp.desc()).execution_options(
+          yield_per=app.config['STREAM_BATCH_SIZE'], full_scan=True)
+  for row in db.session.execute(stmt):
     message_data = {
         'id': row.id,
         'first_name': row.first_name,
@@ -96,10 +902,737 @@ def get_contact_messages():
         'email': row.email,
         'subject': row.subject,
         'message': row.message,
-        'formatted_date': format_date(row.timestamp)
+        'formatted_date': format_date(row.timestamp),
+        'is_read': row.is_read
     }
-    messages.append(message_data)
-  return messages
+    yield message_data
+
+
+def unread_message_count():
+  counter = message_counters_table.c
+  stmt = select(counter.value).where(counter.name == 'unread')
+  return db.session.execute(stmt).scalar() or 0
+
+
+def has_contact_messages(conditions=()):
+  stmt = select(contact_messages_table.c.id).where(
+      *conditions).limit(1).execution_options(full_scan=True)
+  return db.session.execute(stmt).first() is not None
+
+
+def buffer_chunks(chunks, size):
+  # Coalesces Jinja's many small output events into chunks of roughly
+  # `size` characters
+  buffer = []
+  buffered = 0
+  try:
+    for chunk in chunks:
+      buffer.append(chunk)
+      buffered += len(chunk)
+      if buffered >= size:
+        yield ''.join(buffer)
+        buffer = []
+        buffered = 0
+    if buffer:
+      yield ''.join(buffer)
+  finally:
+    chunks.close()
+
+
+def stream_page(template_name, **context):
+  chunks = stream_template(template_name, **context)
+  return buffer_chunks(chunks, app.config['STREAM_BUFFER_SIZE'])
+
+
+def preload_templates():
+  # Compiles through the bytecode cache and keeps the result in the
+  # environment's in-memory cache
+  names = app.jinja_env.list_templates(extensions=['html'])
+  for name in names:
+    app.jinja_env.get_template(name)
+  return names
+
+
+@app.cli.command('precompile-templates')
+def precompile_templates():
+  """Compile all templates into the bytecode cache."""
+  names = preload_templates()
+  click.echo(f"Compiled {len(names)} templates into {template_cache_dir}")
+
+
+# Request Timing
+# Database, template and total handler time are collected per request and
+# sent as a Server-Timing header, which browser devtools display per request.
+# Templates rendered with stream_page finish after the headers are sent, so
+# only their database time up to that point is reported.
+@app.before_request
+def start_request_timer():
+  metrics.inc('http_requests_in_flight')
+  if request.content_length:
+    metrics.inc('http_upload_bytes_total',
+                request.content_length,
+                endpoint=request.endpoint or 'unknown')
+  g.request_started = time.perf_counter()
+  g.db_time = 0.0
+  g.db_queries = 0
+  g.template_time = 0.0
+  g.db_statements = {}
+  g.fragment_hits = 0
+  g.fragment_misses = 0
+  g.response_bytes = 0
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, _cursor, _statement, _parameters, _context,
+                      _executemany):
+  conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+  elapsed = time.perf_counter() - conn.info['query_started'].pop()
+  verb = statement.split(None, 1)[0].upper()
+  metrics.inc('db_queries_total', verb=verb)
+  metrics.observe('db_query_duration_seconds', elapsed, verb=verb)
+  # executemany batches are slow because they are big, so they are left out;
+  # long values such as inline images are abbreviated so they cannot flood
+  # the log
+  if (not executemany
+      and elapsed * 1000 >= app.config['SQL_SLOW_QUERY_MS']):
+    app.logger.warning('Slow query (%.1f ms): %s %s', elapsed * 1000,
+                       statement, reprlib.repr(parameters))
+  if has_app_context() and 'db_time' in g:
+    g.db_time += elapsed
+    g.db_queries += 1
+    if not context.execution_options.get('repeated'):
+      g.db_statements[statement] = g.db_statements.get(statement, 0) + 1
+    if (verb == 'SELECT' and not executemany and explain_enabled()
+        and request.endpoint in app.config['SQL_EXPLAIN_ENDPOINTS']
+        and not context.execution_options.get('full_scan')):
+      warn_on_table_scan(cursor, statement, parameters)
+
+
+# Statements whose plan has already been checked in this process
+explained_statements = set()
+
+
+def explain_enabled():
+  enabled = app.config['SQL_EXPLAIN']
+  return app.debug if enabled is None else enabled
+
+
+def warn_on_table_scan(cursor, statement, parameters):
+  # Queries that are meant to read a whole table opt out with the
+  # full_scan=True execution option
+  if statement in explained_statements:
+    return
+  explained_statements.add(statement)
+  # A diagnostic must never fail the request it is watching
+  try:
+    plan = cursor.connection.execute(f"EXPLAIN QUERY PLAN {statement}",
+                                     parameters).fetchall()
+  except sqlite3.Error as e:
+    app.logger.warning('Could not explain query on %s (%s): %s',
+                       request.endpoint, e, statement)
+    return
+  scans = [detail for _, _, _, detail in plan if detail.startswith('SCAN ')]
+  if scans:
+    app.logger.warning('Full table scan on %s (%s): %s', request.endpoint,
+                       '; '.join(scans), statement)
+
+
+def warn_on_repeated_queries(endpoint, statements):
+  # Statements that are meant to run once per item of a small set, such as
+  # ATTACH per archive file, opt out with the repeated=True execution option
+  threshold = app.config['SQL_REPEAT_THRESHOLD']
+  for statement, count in statements.items():
+    if count >= threshold:
+      app.logger.warning('Possible N+1 on %s: statement ran %d times: %s',
+                         endpoint, count, statement)
+
+
+@before_render_template.connect_via(app)
+def start_template_timer(_sender, **_extra):
+  if 'template_time' in g:
+    g.template_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def stop_template_timer(_sender, **_extra):
+  if 'template_started' in g:
+    g.template_time += time.perf_counter() - g.pop('template_started')
+
+
+def record_request_timing(endpoint, method, status, timings, entry):
+  total = time.perf_counter() - timings.request_started
+  metrics.dec('http_requests_in_flight')
+  metrics.inc('http_requests_total',
+              endpoint=endpoint,
+              method=method,
+              status=status)
+  metrics.observe('http_request_duration_seconds', total, endpoint=endpoint)
+  metrics.observe('http_request_db_seconds', timings.db_time, endpoint=endpoint)
+  metrics.observe('http_request_template_seconds',
+                  timings.template_time,
+                  endpoint=endpoint)
+  metrics.observe('http_response_size_bytes',
+                  timings.response_bytes,
+                  endpoint=endpoint)
+  warn_on_repeated_queries(endpoint, timings.db_statements)
+  if access_log is not None:
+    entry.update(latency_ms=round(total * 1000, 3),
+                 bytes=timings.response_bytes,
+                 db_ms=round(timings.db_time * 1000, 3),
+                 db_queries=timings.db_queries,
+                 fragment_hits=timings.fragment_hits,
+                 fragment_misses=timings.fragment_misses)
+    access_log.write(entry)
+
+
+def count_bytes(chunks, timings):
+  for chunk in chunks:
+    timings.response_bytes += len(
+        chunk if isinstance(chunk, bytes) else chunk.encode())
+    yield chunk
+
+
+@app.after_request
+def add_server_timing(response):
+  if 'request_started' not in g:
+    return response
+  total = time.perf_counter() - g.request_started
+  response.headers['Server-Timing'] = (
+      f'db;desc="{g.db_queries} queries";dur={g.db_time * 1000:.2f}, '
+      f'tpl;dur={g.template_time * 1000:.2f}, '
+      f'app;dur={total * 1000:.2f}')
+
+  endpoint = request.endpoint or 'unknown'
+  method = request.method
+  status = response.status_code
+  entry = {
+      'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+      'method': method,
+      'path': request.path,
+      'route': request.url_rule.rule if request.url_rule else None,
+      'endpoint': endpoint,
+      'status': status,
+      'cache': g.get('cache_policy'),
+  }
+  # Files are passed straight to the server, which never calls their close
+  # callbacks, but their length is known up front
+  if response.is_streamed and not response.direct_passthrough:
+    # The body is still to be rendered; g stays live while it streams
+    timings = g._get_current_object()
+    response.response = count_bytes(response.response, timings)
+    response.call_on_close(lambda: record_request_timing(
+        endpoint, method, status, timings, entry))
+  else:
+    g.response_bytes = response.content_length or 0
+    record_request_timing(endpoint, method, status, g, entry)
+  return response
+
+
+# Background Threads
+class BackgroundThread:
+  # Runs self.run in one daemon thread per process, started on first use. A
+  # forked worker inherits the object but not its thread, so the pid it was
+  # started in is compared on every call, and before_start() replaces any
+  # state the parent's thread was using (e.g. a queue it was draining).
+
+  thread_name = None
+
+  def __init__(self, lock=None):
+    self.lock = lock or threading.Lock()
+    self.pid = None
+    self.thread = None
+
+  def start(self):
+    if self.pid == os.getpid():
+      return
+    with self.lock:
+      if self.pid == os.getpid():
+        return
+      self.before_start()
+      self.thread = threading.Thread(target=self.run,
+                                     name=self.thread_name,
+                                     daemon=True)
+      self.thread.start()
+      self.pid = os.getpid()
+
+  def before_start(self):
+    pass
+
+  def run(self):
+    raise NotImplementedError
+
+
+# Access Log
+class AccessLog(BackgroundThread):
+  # Request threads only enqueue a dict. One background thread per process
+  # serialises the entries and appends whatever has queued up in a single
+  # O_APPEND write, so the request path never touches the disk and workers
+  # sharing the file never interleave within a line.
+
+  thread_name = 'access-log'
+
+  def __init__(self, path, queue_size):
+    super().__init__()
+    self.path = path
+    self.queue = queue.Queue(queue_size)
+
+  def write(self, entry):
+    if self.pid != os.getpid():
+      # The first entry of a process is appended at once: a server that
+      # forks per request (werkzeug with processes=N) leaves with os._exit
+      # right after the response, before a writer thread or atexit hook
+      # would get to it
+      fd = self.open()
+      try:
+        os.write(fd, self.encode([entry]))
+      finally:
+        os.close(fd)
+      self.start()
+      return
+    try:
+      self.queue.put_nowait(entry)
+    except queue.Full:
+      metrics.inc('access_log_dropped_total')
+
+  def before_start(self):
+    self.queue = queue.Queue(self.queue.maxsize)
+    atexit.register(self.stop)
+
+  def stop(self):
+    # Flushes what is queued; None tells the writer to finish
+    if self.pid == os.getpid():
+      self.queue.put(None)
+      self.thread.join(timeout=5)
+
+  def encode(self, entries):
+    return ''.join(
+        json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries
+        if entry is not None).encode()
+
+  def open(self):
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+  def reopen_if_moved(self, fd):
+    # As WatchedFileHandler does: once rotated away, the path names another
+    # file or none at all
+    try:
+      current = os.stat(self.path)
+    except FileNotFoundError:
+      current = None
+    if current is not None:
+      opened = os.fstat(fd)
+      if (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino):
+        return fd
+    os.close(fd)
+    return self.open()
+
+  def run(self):
+    entries = self.queue
+    fd = self.open()
+    while True:
+      batch = [entries.get()]
+      while len(batch) < 1000:
+        try:
+          batch.append(entries.get_nowait())
+        except queue.Empty:
+          break
+      fd = self.reopen_if_moved(fd)
+      os.write(fd, self.encode(batch))
+      if None in batch:
+        os.close(fd)
+        return
+
+
+access_log = None
+if app.config['ACCESS_LOG']:
+  access_log = AccessLog(
+      app.config['ACCESS_LOG_FILE']
+      or os.path.join(app.instance_path, 'access.log'),
+      app.config['ACCESS_LOG_QUEUE_SIZE'])
+
+
+# Response Compression
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.json', '.svg', '.txt', '.html')
+
+# Content-Encoding tokens and the file suffix of their precompressed variant,
+# in order of preference
+STATIC_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def serve_static(filename):
+  path = safe_join(app.static_folder, filename)
+  if path is None or not filename.endswith(COMPRESSIBLE_EXTENSIONS):
+    return app.send_static_file(filename)
+
+  max_age = app.get_send_file_max_age(filename)
+  for encoding, suffix in STATIC_ENCODINGS:
+    if request.accept_encodings.quality(encoding) and os.path.isfile(path +
+                                                                      suffix):
+      mimetype = mimetypes.guess_type(filename)[0]
+      response = send_from_directory(app.static_folder,
+                                     filename + suffix,
+                                     mimetype=mimetype,
+                                     download_name=os.path.basename(filename),
+                                     max_age=max_age)
+      response.headers['Content-Encoding'] = encoding
+      metrics.inc('http_precompressed_responses_total')
+      break
+  else:
+    response = app.send_static_file(filename)
+  response.vary.add('Accept-Encoding')
+  return response
+
+
+app.view_functions['static'] = serve_static
+
+
+def gzip_stream(chunks, level):
+  compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  try:
+    for chunk in chunks:
+      if isinstance(chunk, str):
+        chunk = chunk.encode()
+      # Sync-flush every chunk so the browser can start parsing right away
+      data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+      metrics.inc('http_compression_input_bytes_total', len(chunk))
+      metrics.inc('http_compression_output_bytes_total', len(data))
+      yield data
+    data = compressor.flush()
+    metrics.inc('http_compression_output_bytes_total', len(data))
+    yield data
+  finally:
+    close = getattr(chunks, 'close', None)
+    if close is not None:
+      close()
+
+
+def compress_body(data):
+  accept = request.accept_encodings
+  if brotli is not None and accept.quality('br'):
+    quality = app.config['COMPRESS_BROTLI_QUALITY']
+    return 'br', brotli.compress(data, quality=quality)
+  if accept.quality('gzip'):
+    level = app.config['COMPRESS_LEVEL']
+    return 'gzip', zlib.compress(data, level, wbits=31)
+  return None, data
+
+
+@app.after_request
+def compress_response(response):
+  if (response.mimetype != 'text/html' or response.direct_passthrough
+      or 'Content-Encoding' in response.headers
+      or response.status_code in (204, 304)):
+    return response
+
+  response.vary.add('Accept-Encoding')
+  if response.is_streamed:
+    # Streamed pages are large by construction, so skip the size threshold
+    if request.accept_encodings.quality('gzip'):
+      response.response = gzip_stream(response.response,
+                                      app.config['COMPRESS_LEVEL'])
+      response.headers['Content-Encoding'] = 'gzip'
+      metrics.inc('http_compressed_responses_total')
+    return response
+
+  data = response.get_data()
+  if len(data) < app.config['COMPRESS_MIN_SIZE']:
+    return response
+
+  encoding, compressed = compress_body(data)
+  if encoding is None:
+    return response
+  response.set_data(compressed)
+  response.headers['Content-Encoding'] = encoding
+  metrics.inc('http_compressed_responses_total')
+  metrics.inc('http_compression_input_bytes_total', len(data))
+  metrics.inc('http_compression_output_bytes_total', len(compressed))
+  return response
+
+
+@app.cli.command('compress-static')
+def compress_static():
+  """Write .gz and .br variants of the compressible static files."""
+  level = app.config['COMPRESS_LEVEL']
+  for root, _, files in os.walk(app.static_folder):
+    for name in files:
+      if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+        continue
+      path = os.path.join(root, name)
+      with open(path, 'rb') as f:
+        data = f.read()
+      variants = [('.gz', zlib.compress(data, level, wbits=31))]
+      if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+      for suffix, compressed in variants:
+        # Skip variants that would not be smaller than the original
+        if len(compressed) >= len(data):
+          continue
+        with open(path + suffix, 'wb') as f:
+          f.write(compressed)
+        click.echo(f"{os.path.relpath(path + suffix)}: "
+                   f"{len(data)} -> {len(compressed)} bytes")
+
+
+# HTTP Caching
+# Every endpoint must be listed here; check_cache_policies() refuses to start
+# the app otherwise.
+#   public:     shared caches may store it and serve it stale while revalidating
+#   private:    per-user or state-changing, never stored
+#   immutable:  content-addressed URL that never changes
+ENDPOINT_CACHE_POLICIES = {
+    'static': 'immutable',
+    'home': 'public',
+    'display_projects': 'public',
+    'show_project': 'public',
+    # Renders flashed messages from the session
+    'contact': 'private',
+    'cms_dashboard': 'private',
+    'cms_inbox': 'private',
+    'view_message': 'private',
+    'delete_message': 'private',
+    'bulk_messages': 'private',
+    'cms_archive': 'private',
+    'view_archived_message': 'private',
+    'cms_projects': 'private',
+    'add_project': 'private',
+    'view_project': 'private',
+    'edit_project': 'private',
+    'delete_project': 'private',
+    'metrics_endpoint': 'private',
+}
+
+IMMUTABLE_MAX_AGE = 31536000
+
+
+def static_file_version(filename):
+  # Read from the file's metadata on every call rather than cached, so that
+  # a file edited while the app runs gets a new URL straight away
+  path = safe_join(app.static_folder, filename)
+  if path is None:
+    return None
+  try:
+    info = os.stat(path)
+  except OSError:
+    return None
+  if not S_ISREG(info.st_mode):
+    return None
+  return format(hash((info.st_mtime_ns, info.st_size)) & 0xffffffff, 'x')
+
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+  # Versioned static URLs change whenever the file does, which is what makes
+  # it safe to mark them immutable
+  if endpoint == 'static' and 'v' not in values:
+    version = static_file_version(values['filename'])
+    if version is not None:
+      values['v'] = version
+
+
+def cache_control_for(policy):
+  # Returns the Cache-Control value and the freshness lifetime in seconds
+  if policy == 'public':
+    max_age = app.config['CACHE_PUBLIC_MAX_AGE']
+    stale = app.config['CACHE_STALE_WHILE_REVALIDATE']
+    return (f"public, max-age={max_age}, stale-while-revalidate={stale}",
+            max_age)
+  if policy == 'immutable':
+    return f"public, max-age={IMMUTABLE_MAX_AGE}, immutable", IMMUTABLE_MAX_AGE
+  if policy == 'revalidate':
+    return 'no-cache', None
+  return 'private, no-store', None
+
+
+@app.after_request
+def apply_cache_policy(response):
+  policy = ENDPOINT_CACHE_POLICIES.get(request.endpoint, 'private')
+  if policy == 'immutable':
+    # An unversioned or outdated static URL may change under the client
+    version = static_file_version(request.view_args['filename'])
+    if version is None or request.args.get('v') != version:
+      policy = 'revalidate'
+  # A response that is about to set a session cookie must never be shared
+  if policy != 'private' and (request.method not in ('GET', 'HEAD')
+                              or response.status_code not in (200, 304)
+                              or session.modified
+                              or 'Set-Cookie' in response.headers):
+    policy = 'private'
+
+  g.cache_policy = policy
+  cache_control, max_age = cache_control_for(policy)
+  response.headers['Cache-Control'] = cache_control
+  if max_age is not None:
+    response.expires = datetime.now(timezone.utc) + timedelta(seconds=max_age)
+  else:
+    response.headers.pop('Expires', None)
+  return response
+
+
+def check_cache_policies():
+  missing = sorted(set(app.view_functions) - set(ENDPOINT_CACHE_POLICIES))
+  if missing:
+    raise RuntimeError(
+        f"No cache policy for endpoints: {', '.join(missing)}. "
+        "Add them to ENDPOINT_CACHE_POLICIES.")
+
+
+# Synthetic Data
+SAMPLE_WORDS = ('portfolio', 'design', 'system', 'data', 'pipeline', 'mobile',
+                'app', 'web', 'platform', 'analytics', 'dashboard', 'api',
+                'service', 'cloud', 'migration', 'redesign', 'prototype',
+                'research', 'study', 'brand', 'identity', 'marketing',
+                'campaign', 'accessibility', 'audit', 'performance',
+                'onboarding', 'checkout', 'search', 'experiment',
+                'illustration', 'photography', 'typography', 'motion',
+                'e-commerce', 'booking', 'community', 'open', 'source')
+SAMPLE_NAMES = ('Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Riley',
+                'Jamie', 'Avery', 'Quinn', 'Rowan', 'Charlie', 'Harper',
+                'Skyler', 'Emerson', 'Finley')
+
+# Few title stems with varying case and punctuation, so that many titles
+# slugify to the same value
+TITLE_STEMS = ('Portfolio Redesign', 'portfolio redesign!', 'Data Pipeline',
+               'Data  Pipeline?', 'Mobile App', 'mobile-app',
+               'Brand Identity', 'Brand identity.')
+
+
+class TextSampler:
+  # Slices a pre-generated corpus at word boundaries, which is far cheaper
+  # than assembling every text word by word
+
+  def __init__(self, rng, corpus_words=200000):
+    words = rng.choices(SAMPLE_WORDS, k=corpus_words)
+    self.rng = rng
+    self.corpus = ' '.join(words)
+    self.offsets = [0]
+    for word in words:
+      self.offsets.append(self.offsets[-1] + len(word) + 1)
+
+  def sample(self, min_words, max_words):
+    # Word counts skew short with a long tail
+    random = self.rng.random
+    count = min_words + int((max_words - min_words) * random()**3)
+    start = int((len(self.offsets) - count) * random())
+    text = self.corpus[self.offsets[start]:self.offsets[start + count] - 1]
+    return text[:1].upper() + text[1:]
+
+
+def sample_image(rng, max_size):
+  size = max(1024, int(max_size * rng.random()**3))
+  data = base64.b64encode(rng.randbytes(size * 3 // 4)).decode()
+  return f"data:image/jpeg;base64,{data}"
+
+
+def bulk_insert(connection, table, columns, rows):
+  # Plain DB-API executemany on positional rows, skipping SQLAlchemy's
+  # per-row parameter processing
+  placeholders = ', '.join('?' * len(columns))
+  connection.exec_driver_sql(
+      f"INSERT INTO {table.name} ({', '.join(columns)}) "
+      f"VALUES ({placeholders})", rows)
+
+
+def generate_projects(connection, count, rng, image_ratio, max_image_size,
+                      batch_size):
+  from slugify import slugify
+
+  # Slug collisions are resolved in memory the same way generate_slug does,
+  # instead of querying once per row
+  taken = set(connection.execute(select(projects_table.c.slug)).scalars())
+  next_suffix = {}
+  texts = TextSampler(rng)
+  default_image = '/static/img/project_thumbnail.jpg'
+  columns = ('slug', 'title', 'description', 'image', 'version')
+  rows = []
+  for _ in range(count):
+    title = rng.choice(TITLE_STEMS)
+    if rng.random() < 0.5:
+      title = f"{title} {rng.choice(SAMPLE_WORDS)}"
+    slug_base = slugify(title)
+    slug = slug_base
+    while slug in taken:
+      suffix = next_suffix.get(slug_base, 1)
+      next_suffix[slug_base] = suffix + 1
+      slug = f"{slug_base}-{suffix}"
+    taken.add(slug)
+    image = (sample_image(rng, max_image_size)
+             if rng.random() < image_ratio else default_image)
+    rows.append((slug, title, texts.sample(10, 2000), image,
+                 new_content_version()))
+    if len(rows) >= batch_size:
+      bulk_insert(connection, projects_table, columns, rows)
+      rows = []
+  if rows:
+    bulk_insert(connection, projects_table, columns, rows)
+
+
+def generate_messages(connection, count, rng, years, batch_size):
+  now = datetime.now()
+  span = years * 365 * 24 * 3600
+  texts = TextSampler(rng)
+  columns = ('id', 'first_name', 'last_name', 'email', 'subject', 'message',
+             'timestamp', 'is_read')
+  # rng.random() arithmetic is several times cheaper than randrange/choice,
+  # which matters at millions of rows
+  random = rng.random
+  names = len(SAMPLE_NAMES)
+  rows = []
+  for i in range(count):
+    first_name = SAMPLE_NAMES[int(names * random())]
+    last_name = SAMPLE_NAMES[int(names * random())]
+    timestamp = now - timedelta(seconds=int(span * random()))
+    rows.append((
+        str(UUID(int=rng.getrandbits(128), version=4)),
+        first_name,
+        last_name,
+        f"{first_name}.{last_name}{i}@example.com".lower(),
+        texts.sample(2, 12),
+        texts.sample(5, 200),
+        # str() gives the ISO form SQLAlchemy's SQLite DateTime type parses,
+        # at half the cost of strftime
+        str(timestamp),
+        # Most of an established inbox has been read
+        random() < 0.9,
+    ))
+    if len(rows) >= batch_size:
+      bulk_insert(connection, contact_messages_table, columns, rows)
+      rows = []
+  if rows:
+    bulk_insert(connection, contact_messages_table, columns, rows)
+
+
+@app.cli.command('generate-data')
+@click.option('--projects', default=1000, help='Projects to create.')
+@click.option('--messages', default=10000, help='Contact messages to create.')
+@click.option('--image-ratio',
+              default=0.5,
+              help='Share of projects with an inline image.')
+@click.option('--max-image-size',
+              default=262144,
+              help='Largest inline image in bytes.')
+@click.option('--years',
+              default=5,
+              help='Spread message timestamps over this many years.')
+@click.option('--seed', default=None, type=int, help='Random seed.')
+@click.option('--batch-size', default=10000, help='Rows per executemany.')
+def generate_data(projects, messages, image_ratio, max_image_size, years, seed,
+                  batch_size):
+  """Bulk-insert synthetic projects and contact messages."""
+  rng = random.Random(seed)
+  init_db()
+  started = time.perf_counter()
+  with db.engine.begin() as connection:
+    generate_projects(connection, projects, rng, image_ratio, max_image_size,
+                      batch_size)
+    generate_messages(connection, messages, rng, years, batch_size)
+  click.echo(f"Inserted {projects} projects and {messages} messages in "
+             f"{time.perf_counter() - started:.1f}s")
 
 
 # CMS Routes
@@ -111,28 +1644,43 @@ def cms_dashboard():
 # Messages
 @app.get('/cms/inbox')
 def cms_inbox():
-  messages = get_contact_messages()
-  return render_template("cms/cms_inbox.html", messages=messages[::-1])
+  filters = inbox_filters(request.args)
+  conditions = contact_message_conditions(filters)
+  # Flashes are taken here because the session cannot be saved once the
+  # streamed response has started
+  return stream_page("cms/cms_inbox.html",
+                     messages=iter_contact_messages(conditions),
+                     has_messages=has_contact_messages(conditions),
+                     filters=filters,
+                     flashes=get_flashed_messages(with_categories=True))
 
 
 @app.get('/cms/inbox/view/<uuid:id>')
 def view_message(id):
   message_id = str(id)
 
-  results = db.session.execute(select(contact_messages_table)).fetchall()
-
-  message = {}
-  for row in results:
-    if row.id == message_id:
-      message['first_name'] = row.first_name
-      message['last_name'] = row.last_name
-      message['subject'] = row.subject
-      message['email'] = row.email
-      message['formatted_date'] = format_date(row.timestamp)
-      message['message'] = row.message
-  if message is None:
+  stmt = select(contact_messages_table).where(
+      contact_messages_table.c.id == message_id)
+  row = db.session.execute(stmt).first()
+  if row is None:
     flash('Message not found', 'error')
     return redirect(url_for('cms_inbox'))
+
+  if not row.is_read:
+    db.session.execute(
+        update(contact_messages_table).where(
+            contact_messages_table.c.id == message_id).values(is_read=True))
+    db.session.commit()
+
+  message = {
+      'id': row.id,
+      'first_name': row.first_name,
+      'last_name': row.last_name,
+      'subject': row.subject,
+      'email': row.email,
+      'formatted_date': format_date(row.timestamp),
+      'message': row.message
+  }
   return render_template('cms/cms_view_message.html', message=message)
 
 
@@ -149,6 +1697,265 @@ def delete_message(id):
   return redirect(url_for('cms_inbox'))
 
 
+@app.post('/cms/inbox/bulk')
+def bulk_messages():
+  # Applies one action either to the checked messages or to every message
+  # matching the inbox filters, as a single statement
+  filters = inbox_filters(request.form)
+  if request.form.get('scope') == 'matching':
+    conditions = contact_message_conditions(filters)
+    if not conditions:
+      flash('Set a filter before acting on all matching messages', 'warning')
+      return redirect(url_for('cms_inbox', **filters))
+  else:
+    ids = request.form.getlist('ids')
+    if not ids:
+      flash('No messages selected', 'warning')
+      return redirect(url_for('cms_inbox', **filters))
+    conditions = [contact_messages_table.c.id.in_(ids)]
+
+  action = request.form.get('action')
+  if action == 'delete':
+    stmt = delete(contact_messages_table).where(*conditions)
+    done = 'Deleted'
+  elif action in ('mark_read', 'mark_unread'):
+    is_read = action == 'mark_read'
+    # Rows already in that state are left alone, so the count is of
+    # messages that changed
+    stmt = update(contact_messages_table).where(
+        *conditions,
+        contact_messages_table.c.is_read == (false() if is_read else true())
+    ).values(is_read=is_read)
+    done = 'Marked as read' if is_read else 'Marked as unread'
+  else:
+    abort(400)
+  result = db.session.execute(stmt)
+  db.session.commit()
+  flash(
+      f"{done}: {result.rowcount} message"
+      f"{'' if result.rowcount == 1 else 's'}", 'success')
+  return redirect(url_for('cms_inbox', **filters))
+
+
+@app.context_processor
+def inject_unread_messages():
+  # A function rather than the count itself, so that only templates showing
+  # it (the CMS sidebar) read the counter
+  return {'unread_messages': unread_message_count}
+
+
+# Message Archive
+ARCHIVE_FILE_PATTERN = re.compile(r'messages-(\d{4})-(\d{2})\.db')
+
+
+def archive_dir():
+  return (app.config['ARCHIVE_DIR'] or os.path.join(
+      os.path.dirname(db.engine.url.database), 'archive'))
+
+
+def archive_path(month):
+  return os.path.join(archive_dir(), f"messages-{month:%Y-%m}.db")
+
+
+def add_months(month, count):
+  index = month.year * 12 + month.month - 1 + count
+  return datetime(index // 12, index % 12 + 1, 1)
+
+
+def archive_cutoff(months):
+  # Start of the oldest month that is kept, so only whole months move
+  return add_months(datetime.now().replace(day=1), -months)
+
+
+def archive_months():
+  # Months that have an archive file, newest first
+  try:
+    names = os.listdir(archive_dir())
+  except FileNotFoundError:
+    return []
+  months = []
+  for name in names:
+    match = ARCHIVE_FILE_PATTERN.fullmatch(name)
+    if match:
+      months.append(datetime(int(match[1]), int(match[2]), 1))
+  return sorted(months, reverse=True)
+
+
+@contextmanager
+def attached_archive(month):
+  # A connection of its own, so that the ATTACH never outlives the block in
+  # the pool. ATTACH creates a missing file.
+  with db.engine.connect() as connection:
+    connection.exec_driver_sql('ATTACH DATABASE ? AS archive',
+                               (archive_path(month), ))
+    try:
+      yield connection
+    finally:
+      connection.rollback()
+      connection.exec_driver_sql('DETACH DATABASE archive')
+
+
+# SQLite attaches at most 10 databases to a connection by default. Searches
+# attach that many months at once, as archive_0 to archive_9, and read them
+# in one UNION ALL.
+ARCHIVES_PER_QUERY = 10
+archive_slot_tables = [
+    archived_messages_table.to_metadata(MetaData(), schema=f"archive_{slot}")
+    for slot in range(ARCHIVES_PER_QUERY)
+]
+
+
+@contextmanager
+def attached_archives(months):
+  # Yields the connection and one table per month, in the order given
+  with db.engine.connect() as connection:
+    options = {'repeated': True}
+    attached = 0
+    try:
+      for slot, month in enumerate(months):
+        connection.exec_driver_sql(f"ATTACH DATABASE ? AS archive_{slot}",
+                                   (archive_path(month), ),
+                                   execution_options=options)
+        attached += 1
+      yield connection, archive_slot_tables[:attached]
+    finally:
+      connection.rollback()
+      for slot in range(attached):
+        connection.exec_driver_sql(f"DETACH DATABASE archive_{slot}",
+                                   execution_options=options)
+
+
+def archive_month(month, cutoff):
+  # Copies the month's messages into its archive and deletes them from the
+  # inbox in one transaction. INSERT OR IGNORE makes an interrupted run
+  # safe to repeat.
+  messages = contact_messages_table.c
+  in_month = ((messages.timestamp >= month) &
+              (messages.timestamp < min(add_months(month, 1), cutoff)))
+  columns = archived_messages_table.c.keys()
+  os.makedirs(archive_dir(), exist_ok=True)
+  with attached_archive(month) as connection:
+    archived_messages_table.create(connection, checkfirst=True)
+    connection.execute(archived_messages_table.insert().prefix_with(
+        'OR IGNORE').from_select(
+            columns,
+            select(*(messages[name] for name in columns)).where(in_month)))
+    moved = connection.execute(
+        delete(contact_messages_table).where(in_month)).rowcount
+    connection.commit()
+  return moved
+
+
+def archive_messages(cutoff):
+  # Archives everything older than cutoff, one month per transaction,
+  # oldest first
+  messages = contact_messages_table.c
+  oldest_stmt = select(func.min(messages.timestamp)).where(
+      messages.timestamp < cutoff)
+  moved = {}
+  while True:
+    # A connection of its own: this also runs in the maintenance thread,
+    # whose app context never ends
+    with db.engine.connect() as connection:
+      oldest = connection.execute(oldest_stmt).scalar()
+    if oldest is None:
+      return moved
+    month = oldest.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    moved[month] = archive_month(month, cutoff)
+
+
+def search_archives(filters, limit):
+  # Newest first across the archive files, skipping months outside the
+  # filter's date range. Months do not overlap, so each group of attached
+  # months is only read while the limit has not been reached.
+  date_from = parse_filter_date(filters.get('date_from', ''))
+  date_to = parse_filter_date(filters.get('date_to', ''))
+  months = [
+      month for month in archive_months()
+      if not ((date_from is not None and add_months(month, 1) <= date_from) or
+              (date_to is not None and month > date_to))
+  ]
+  results = []
+  for start in range(0, len(months), ARCHIVES_PER_QUERY):
+    if len(results) >= limit:
+      break
+    group = months[start:start + ARCHIVES_PER_QUERY]
+    with attached_archives(group) as (connection, tables):
+      stmt = union_all(*(select(
+          table, literal(f"{month:%Y-%m}").label('month')).where(
+              *contact_message_conditions(filters, table))
+                         for month, table in zip(group, tables, strict=True)))
+      stmt = stmt.order_by(stmt.selected_columns.timestamp.desc()).limit(
+          limit - len(results))
+      for row in connection.execute(stmt):
+        results.append({
+            'id': row.id,
+            'month': row.month,
+            'first_name': row.first_name,
+            'last_name': row.last_name,
+            'subject': row.subject,
+            'message': row.message,
+            'formatted_date': format_date(row.timestamp)
+        })
+  return results
+
+
+@app.cli.command('archive-messages')
+@click.option('--months',
+              type=int,
+              help='Keep this many whole months (default: RETENTION_MONTHS).')
+def archive_messages_command(months):
+  """Move old contact messages into monthly archive files."""
+  months = months if months is not None else app.config['RETENTION_MONTHS']
+  if months is None:
+    raise click.UsageError('Set RETENTION_MONTHS or pass --months')
+  init_db()
+  moved = archive_messages(archive_cutoff(months))
+  for month, count in moved.items():
+    click.echo(f"{month:%Y-%m}: {count} messages -> {archive_path(month)}")
+  click.echo(f"Archived {sum(moved.values())} messages")
+
+
+@app.get('/cms/archive')
+def cms_archive():
+  filters = inbox_filters(request.args)
+  return render_template('cms/cms_archive.html',
+                         messages=search_archives(
+                             filters, app.config['ARCHIVE_SEARCH_LIMIT']),
+                         has_archives=bool(archive_months()),
+                         filters=filters,
+                         limit=app.config['ARCHIVE_SEARCH_LIMIT'])
+
+
+@app.get('/cms/archive/<month>/<uuid:id>')
+def view_archived_message(month, id):
+  try:
+    month = datetime.strptime(month, '%Y-%m')
+  except ValueError:
+    abort(404)
+  if month not in archive_months():
+    abort(404)
+  stmt = select(archived_messages_table).where(
+      archived_messages_table.c.id == str(id))
+  with attached_archive(month) as connection:
+    row = connection.execute(stmt).first()
+  if row is None:
+    abort(404)
+
+  message = {
+      'id': row.id,
+      'first_name': row.first_name,
+      'last_name': row.last_name,
+      'subject': row.subject,
+      'email': row.email,
+      'formatted_date': format_date(row.timestamp),
+      'message': row.message
+  }
+  return render_template('cms/cms_view_message.html',
+                         message=message,
+                         archived=True)
+
+
 # Project
 @app.get('/cms/projects')
 def cms_projects():
@@ -168,12 +1975,17 @@ def add_project():
       image_data = url_for('static', filename='img/project_thumbnail.jpg')
 
     slug = generate_slug(title)
+    version = new_content_version()
     insert_stmt = projects_table.insert().values(slug=slug,
                                                  title=title,
                                                  description=description,
-                                                 image=image_data)
+                                                 image=image_data,
+                                                 version=version)
     db.session.execute(insert_stmt)
     db.session.commit()
+    if webhooks is not None:
+      webhooks.emit('project.created',
+                    project_event_data(slug, title, description, version))
 
     return redirect(url_for('cms_projects'))
   return render_template("cms/cms_add_project.html")
@@ -181,8 +1993,7 @@ def add_project():
 
 @app.get('/cms/projects/<string:slug>')
 def view_project(slug):
-  projects = get_projects()
-  project = projects[slug]
+  project = get_project(slug)
   if project is None:
     return 'Project not found', 404
   return render_template("cms/cms_view_project.html", project=project)
@@ -190,8 +2001,7 @@ def view_project(slug):
 
 @app.route('/cms/projects/edit/<string:slug>', methods=['GET', 'POST'])
 def edit_project(slug):
-  projects = get_projects()
-  project = projects.get(slug)
+  project = get_project(slug)
 
   if project is None:
     return 'Project not found', 404
@@ -206,12 +2016,17 @@ def edit_project(slug):
     else:
       image_data = project['image']
 
+    version = new_content_version()
     update_stmt = update(projects_table).where(
         projects_table.c.slug == slug).values(title=title,
                                               description=description,
-                                              image=image_data)
+                                              image=image_data,
+                                              version=version)
     db.session.execute(update_stmt)
     db.session.commit()
+    if webhooks is not None:
+      webhooks.emit('project.updated',
+                    project_event_data(slug, title, description, version))
     return redirect(url_for('cms_projects'))
 
   return render_template("cms/cms_edit_project.html",
@@ -226,9 +2041,1143 @@ def delete_project(slug):
   db.session.commit()
   if result.rowcount == 0:
     return 'Project not found', 404
+  if webhooks is not None:
+    webhooks.emit('project.deleted', {'slug': slug})
   return redirect(url_for('cms_projects'))
 
 
+# Monitoring
+@app.get('/metrics')
+def metrics_endpoint():
+  if request.remote_addr not in app.config['METRICS_ALLOWED_ADDRS']:
+    abort(404)
+  return metrics.render(), 200, {
+      'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+  }
+
+
+# Profiling
+# A request is profiled when it carries an unexpired token for its method and
+# path, either in an X-Profile header or a _profile query parameter. Tokens
+# are "<expiry>.<signature>" and are printed by `flask profile-token`. The
+# pstats file name is returned in the X-Profile response header.
+def profile_token(method, path, expires):
+  secret = app.config['PROFILER_SECRET']
+  message = f"{method.upper()} {path} {expires}".encode()
+  signature = hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+  return f"{expires}.{signature}"
+
+
+def valid_profile_token(token, method, path):
+  expires, _, _ = token.partition('.')
+  if not expires.isdigit() or int(expires) < time.time():
+    return False
+  return hmac.compare_digest(token, profile_token(method, path, expires))
+
+
+class RequestProfiler:
+
+  def __init__(self, wsgi_app):
+    self.wsgi_app = wsgi_app
+
+  def requested_token(self, environ):
+    token = environ.get('HTTP_X_PROFILE')
+    if token is None and '_profile=' in environ.get('QUERY_STRING', ''):
+      query = parse_qs(environ['QUERY_STRING'])
+      token = query.get('_profile', [None])[0]
+    return token
+
+  def __call__(self, environ, start_response):
+    token = self.requested_token(environ)
+    if token is None or not app.config['PROFILER_SECRET']:
+      return self.wsgi_app(environ, start_response)
+    method = environ['REQUEST_METHOD']
+    path = environ.get('PATH_INFO', '/')
+    if not valid_profile_token(token, method, path):
+      return self.wsgi_app(environ, start_response)
+    return self.profile(environ, start_response, method, path)
+
+  def profile(self, environ, start_response, method, path):
+    import cProfile
+
+    profile_dir = (app.config['PROFILE_DIR']
+                   or os.path.join(app.instance_path, 'profiles'))
+    os.makedirs(profile_dir, exist_ok=True)
+    name = (f"{datetime.now():%Y%m%dT%H%M%S.%f}-{method}-"
+            f"{path.strip('/').replace('/', '.') or 'root'}.prof")
+
+    def profiled_start_response(status, headers, exc_info=None):
+      headers.append(('X-Profile', name))
+      return start_response(status, headers, exc_info)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+      # Streamed bodies are rendered while iterating, so consume them here
+      app_iter = self.wsgi_app(environ, profiled_start_response)
+      try:
+        body = list(app_iter)
+      finally:
+        if hasattr(app_iter, 'close'):
+          app_iter.close()
+    finally:
+      profiler.disable()
+      profiler.dump_stats(os.path.join(profile_dir, name))
+      self.prune(profile_dir)
+    return body
+
+  def prune(self, profile_dir):
+    # File names start with their timestamp, so they sort oldest first
+    profiles = sorted(glob.glob(os.path.join(profile_dir, '*.prof')))
+    for path in profiles[:-app.config['PROFILE_MAX_FILES'] or None]:
+      with suppress(FileNotFoundError):
+        os.remove(path)
+
+
+app.wsgi_app = RequestProfiler(app.wsgi_app)
+
+
+@app.cli.command('profile-token')
+@click.argument('method')
+@click.argument('path')
+@click.option('--expires-in',
+              type=int,
+              help='Token lifetime in seconds (default: PROFILE_TOKEN_SECONDS).')
+def profile_token_command(method, path, expires_in):
+  """Print the X-Profile token for METHOD and PATH."""
+  if not app.config['PROFILER_SECRET']:
+    raise click.ClickException('PROFILER_SECRET is not configured')
+  if expires_in is None:
+    expires_in = app.config['PROFILE_TOKEN_SECONDS']
+  click.echo(profile_token(method, path, int(time.time()) + expires_in))
+
+
+# Contact Writes
+def insert_contact_messages(connection, rows):
+  # Ids are generated once per submission, so a row that already exists was
+  # written by an earlier attempt (e.g. a replayed journal). Returns the rows
+  # this call wrote; only those are notified and announced.
+  stmt = contact_messages_table.insert().prefix_with('OR IGNORE').returning(
+      contact_messages_table.c.id)
+  written = set(connection.execute(stmt, rows).scalars())
+  rows = [row for row in rows if row['id'] in written]
+  if notifier is not None and rows:
+    enqueue_notifications(connection, rows)
+  return rows
+
+
+def contact_content_hash(email, subject, message, timestamp):
+  window = app.config['CONTACT_DUPLICATE_WINDOW_MINUTES']
+  if not window:
+    return None
+  # Fixed windows: a resubmission that crosses a window boundary is kept
+  bucket = int(timestamp.timestamp() // (window * 60))
+  content = '\0'.join(((email or '').strip().lower(), (subject or '').strip(),
+                       (message or '').strip(), str(bucket)))
+  return hashlib.sha256(content.encode()).hexdigest()
+
+
+def is_lock_error(error):
+  return isinstance(error, OperationalError) and 'locked' in str(error.orig)
+
+
+@contextmanager
+def busy_timeout(connection, seconds):
+  # Waits at most this long for the SQLite write lock instead of the driver's
+  # default of 5 seconds
+  if seconds is None:
+    yield
+    return
+  # Set on the driver connection, so that it does not begin a transaction
+  sqlite = connection.connection.driver_connection
+  previous = sqlite.execute('PRAGMA busy_timeout').fetchone()[0]
+  sqlite.execute(f"PRAGMA busy_timeout = {int(seconds * 1000)}")
+  try:
+    yield
+  finally:
+    sqlite.execute(f"PRAGMA busy_timeout = {previous}")
+
+
+def write_contact_messages(rows):
+  # Journals the rows instead when the database stays locked
+  timeout = app.config['CONTACT_LOCK_TIMEOUT'] if contact_spool else None
+  try:
+    with (db.engine.connect() as connection,
+          busy_timeout(connection, timeout), connection.begin()):
+      written = insert_contact_messages(connection, rows)
+  except OperationalError as e:
+    if contact_spool is None or not is_lock_error(e):
+      raise
+    contact_spool.append(rows)
+    return
+  contact_messages_stored(written)
+
+
+def lock_file(f):
+  if fcntl is not None:
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+class ContactSpool(BackgroundThread):
+  # Append-only JSON-lines journal. Appends hold an exclusive flock and are
+  # fsynced before the visitor is told the message was sent. The replayer
+  # claims the journal by renaming it, so that new appends start a fresh
+  # file, and inserts with OR IGNORE, so an interrupted replay can simply
+  # run again.
+
+  thread_name = 'contact-spool'
+
+  def __init__(self, path, interval):
+    super().__init__()
+    self.path = path
+    self.interval = interval
+
+  def append(self, rows):
+    self.start()
+    data = ''.join(
+        json.dumps(dict(row, timestamp=row['timestamp'].isoformat())) + '\n'
+        for row in rows)
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    while True:
+      with open(self.path, 'a', encoding='utf-8') as f:
+        lock_file(f)
+        # The replayer may have claimed the file while this waited for the
+        # lock; the rows must then go to a fresh one
+        if not self.is_current(f):
+          continue
+        created = f.tell() == 0
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+      if created:
+        # Make the new directory entry durable as well
+        directory = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+          os.fsync(directory)
+        finally:
+          os.close(directory)
+      metrics.inc('contact_spooled_total', len(rows))
+      app.logger.warning('Database locked; journaled %d contact messages',
+                         len(rows))
+      return
+
+  def is_current(self, f):
+    try:
+      return os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino
+    except FileNotFoundError:
+      return False
+
+  def claim(self):
+    try:
+      with open(self.path, 'rb') as f:
+        lock_file(f)
+        if self.is_current(f):
+          os.rename(self.path,
+                    f"{self.path}.{os.getpid()}-{time.time_ns()}.replaying")
+    except FileNotFoundError:
+      pass
+    # Includes files claimed by processes that died before replaying them
+    return sorted(glob.glob(f"{glob.escape(self.path)}.*.replaying"))
+
+  def replay(self):
+    total = 0
+    for claimed in self.claim():
+      try:
+        replayed = self.replay_file(claimed)
+      except FileNotFoundError:
+        # Replayed by another process in the meantime
+        continue
+      except OperationalError as e:
+        if not is_lock_error(e):
+          app.logger.exception('Replaying %s failed', claimed)
+        # Try again in the next round
+        break
+      metrics.inc('contact_spool_replayed_total', replayed)
+      total += replayed
+    if total:
+      app.logger.info('Replayed %d journaled contact messages', total)
+    return total
+
+  def replay_file(self, claimed):
+    with open(claimed, encoding='utf-8') as f:
+      # Waits for an append that started before the file was claimed
+      lock_file(f)
+      lines = f.read().splitlines()
+    # Journals written before a column was added lack its key; columns with
+    # a server default are left to it
+    spool_columns = [
+        column.name for column in contact_messages_table.c
+        if column.server_default is None
+    ]
+    rows = []
+    for line in lines:
+      try:
+        row = dict.fromkeys(spool_columns) | json.loads(line)
+      except ValueError:
+        app.logger.warning('Skipping a truncated line in %s', claimed)
+        continue
+      row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+      rows.append(row)
+    if rows:
+      with db.engine.begin() as connection:
+        written = insert_contact_messages(connection, rows)
+      contact_messages_stored(written)
+    os.remove(claimed)
+    return len(rows)
+
+  def run(self):
+    with app.app_context():
+      while True:
+        time.sleep(self.interval)
+        try:
+          self.replay()
+        except Exception:
+          app.logger.exception('Replaying the contact journal failed')
+
+
+class PendingWrite:
+
+  def __init__(self, row):
+    self.row = row
+    self.done = threading.Event()
+    self.error = None
+
+
+class ContactWriter(BackgroundThread):
+  # Requests queue their row and wait. One background thread per process
+  # collects whatever arrives within batch_seconds (at most batch_size rows),
+  # inserts it in a single transaction and then wakes the waiting requests,
+  # so a burst pays for one commit per batch instead of one per message.
+
+  thread_name = 'contact-writer'
+
+  def __init__(self, batch_seconds, batch_size):
+    super().__init__()
+    self.batch_seconds = batch_seconds
+    self.batch_size = batch_size
+    self.queue = queue.Queue()
+
+  def submit(self, row, timeout):
+    self.start()
+    pending = PendingWrite(row)
+    self.queue.put(pending)
+    if not pending.done.wait(timeout):
+      raise TimeoutError('Timed out waiting for the contact writer')
+    if pending.error is not None:
+      raise pending.error
+
+  def before_start(self):
+    self.queue = queue.Queue()
+
+  def run(self):
+    pending_writes = self.queue
+    with app.app_context():
+      while True:
+        batch = [pending_writes.get()]
+        deadline = time.monotonic() + self.batch_seconds
+        while len(batch) < self.batch_size:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            break
+          try:
+            batch.append(pending_writes.get(timeout=remaining))
+          except queue.Empty:
+            break
+        self.write(batch)
+
+  def write(self, batch):
+    try:
+      write_contact_messages([pending.row for pending in batch])
+      metrics.observe('contact_write_batch_size', len(batch))
+    except Exception:
+      app.logger.exception('Batched insert of %d contact messages failed',
+                           len(batch))
+      # Retry one by one so that a bad row only fails its own request
+      for pending in batch:
+        try:
+          write_contact_messages([pending.row])
+        except Exception as e:
+          pending.error = e
+    for pending in batch:
+      pending.done.set()
+
+
+contact_writer = None
+if app.config['CONTACT_WRITE_BEHIND']:
+  contact_writer = ContactWriter(app.config['CONTACT_BATCH_MS'] / 1000,
+                                 app.config['CONTACT_BATCH_SIZE'])
+
+contact_spool = None
+if app.config['CONTACT_SPOOL']:
+  contact_spool = ContactSpool(
+      app.config['CONTACT_SPOOL_FILE'] or os.path.join(
+          os.path.dirname(db.engine.url.database), 'contact_spool.jsonl'),
+      app.config['CONTACT_SPOOL_INTERVAL'])
+
+  @app.before_request
+  def start_spool_replayer():
+    # Every process replays, including ones that never had to journal
+    contact_spool.start()
+
+
+@app.cli.command('replay-contact-spool')
+def replay_contact_spool():
+  """Insert journaled contact messages into the database now."""
+  if contact_spool is None:
+    raise click.ClickException('CONTACT_SPOOL is disabled')
+  click.echo(f"Replayed {contact_spool.replay()} contact messages")
+
+
+# Notifications
+def enqueue_notifications(connection, rows):
+  # Called with the rows an insert actually wrote, so duplicates are never
+  # queued; OR IGNORE still skips a message that is already waiting in the
+  # outbox
+  now = datetime.now()
+  connection.execute(
+      notification_outbox_table.insert().prefix_with('OR IGNORE'),
+      [{
+          'message_id': row['id'],
+          'next_attempt': now
+      } for row in rows])
+
+
+def retry_delay(attempts):
+  delay = min(app.config['NOTIFY_RETRY_SECONDS'] * 2**(attempts - 1), 3600)
+  # Jitter keeps workers that failed together from retrying together
+  return timedelta(seconds=delay * (0.5 + random.random() / 2))
+
+
+def format_notification(message):
+  name = f"{message.first_name or ''} {message.last_name or ''}".strip()
+  return (f"From: {name} <{message.email}>\n"
+          f"Date: {message.timestamp:%Y-%m-%d %H:%M}\n"
+          f"Subject: {message.subject}\n\n{message.message}\n")
+
+
+class Notifier(BackgroundThread):
+  # One worker thread per process. Every worker claims due rows by pushing
+  # their next_attempt past a lease, so several processes never send the
+  # same notification twice unless one dies mid-send.
+
+  LEASE = timedelta(minutes=5)
+  CLAIM_LIMIT = 100
+  thread_name = 'notifier'
+
+  def __init__(self, interval, digest_threshold, max_attempts):
+    super().__init__()
+    self.interval = interval
+    self.digest_threshold = digest_threshold
+    self.max_attempts = max_attempts
+
+  def run(self):
+    with app.app_context():
+      while True:
+        # Polling rather than waking per message lets a burst pile up into
+        # one digest
+        time.sleep(self.interval)
+        try:
+          while self.send_due():
+            pass
+        except Exception:
+          app.logger.exception('Sending notifications failed')
+
+  def claim(self, connection):
+    outbox = notification_outbox_table
+    now = datetime.now()
+    due = select(outbox.c.id).where(outbox.c.next_attempt <= now).order_by(
+        outbox.c.id).limit(self.CLAIM_LIMIT)
+    return connection.execute(
+        update(outbox).where(outbox.c.id.in_(due.scalar_subquery())).values(
+            next_attempt=now + self.LEASE).returning(
+                outbox.c.id, outbox.c.message_id, outbox.c.attempts)).all()
+
+  def send_due(self):
+    # Returns the number of claimed notifications, 0 once none are due
+    with db.engine.begin() as connection:
+      claimed = self.claim(connection)
+    if not claimed:
+      return 0
+    with db.engine.connect() as connection:
+      messages = {
+          message.id: message
+          for message in connection.execute(
+              select(contact_messages_table).where(
+                  contact_messages_table.c.id.in_(
+                      [row.message_id for row in claimed])))
+      }
+    # Notifications of messages deleted in the meantime are dropped
+    done = [row.id for row in claimed if row.message_id not in messages]
+    found = [row for row in claimed if row.message_id in messages]
+    if len(found) >= self.digest_threshold:
+      emails = [('digest', [row.id for row in found],
+                 self.digest([messages[row.message_id] for row in found]))]
+    else:
+      emails = [('single', [row.id], self.single(messages[row.message_id]))
+                for row in found]
+
+    sent, error = self.deliver([email for _, _, email in emails])
+    for kind, ids, _ in emails[:sent]:
+      metrics.inc('notifications_sent_total', kind=kind)
+      done.extend(ids)
+    failed = [i for _, ids, _ in emails[sent:] for i in ids]
+    with db.engine.begin() as connection:
+      if done:
+        connection.execute(delete(notification_outbox_table).where(
+            notification_outbox_table.c.id.in_(done)))
+      if failed:
+        self.reschedule(connection, [row for row in claimed if row.id in failed],
+                        error)
+    return len(claimed)
+
+  def reschedule(self, connection, rows, error):
+    metrics.inc('notification_failures_total', len(rows))
+    app.logger.warning('Sending %d notifications failed: %s', len(rows), error)
+    now = datetime.now()
+    for row in rows:
+      attempts = row.attempts + 1
+      if attempts >= self.max_attempts:
+        app.logger.error('Giving up on the notification for message %s',
+                         row.message_id)
+        next_attempt = None
+      else:
+        next_attempt = now + retry_delay(attempts)
+      connection.execute(
+          update(notification_outbox_table).where(
+              notification_outbox_table.c.id == row.id).values(
+                  attempts=attempts,
+                  next_attempt=next_attempt,
+                  last_error=str(error)[:500]))
+
+  def single(self, message):
+    email = self.new_email(f"New message: {message.subject}")
+    email['Reply-To'] = message.email
+    email.set_content(format_notification(message))
+    return email
+
+  def digest(self, messages):
+    email = self.new_email(f"{len(messages)} new contact messages")
+    email.set_content('\n\n'.join(
+        format_notification(message) for message in messages))
+    return email
+
+  def new_email(self, subject):
+    from email.message import EmailMessage
+
+    email = EmailMessage()
+    email['Subject'] = subject
+    email['From'] = app.config['NOTIFY_FROM']
+    email['To'] = app.config['NOTIFY_EMAIL']
+    return email
+
+  def deliver(self, emails):
+    # Returns how many were sent before the first error, and that error
+    import smtplib
+
+    sent = 0
+    try:
+      with smtplib.SMTP(app.config['NOTIFY_SMTP_HOST'],
+                        app.config['NOTIFY_SMTP_PORT'],
+                        timeout=30) as smtp:
+        if app.config['NOTIFY_SMTP_STARTTLS']:
+          smtp.starttls()
+        if app.config['NOTIFY_SMTP_USERNAME']:
+          smtp.login(app.config['NOTIFY_SMTP_USERNAME'],
+                     app.config['NOTIFY_SMTP_PASSWORD'])
+        for email in emails:
+          smtp.send_message(email)
+          sent += 1
+    except (OSError, smtplib.SMTPException) as e:
+      return sent, e
+    return sent, None
+
+
+notifier = None
+if app.config['NOTIFY_EMAIL']:
+  notifier = Notifier(app.config['NOTIFY_INTERVAL'],
+                      app.config['NOTIFY_DIGEST_THRESHOLD'],
+                      app.config['NOTIFY_MAX_ATTEMPTS'])
+
+  @app.before_request
+  def start_notifier():
+    # Picks up notifications left over from before a restart
+    notifier.start()
+
+
+@app.cli.command('send-notifications')
+@click.option('--retry-failed',
+              is_flag=True,
+              help='Also retry notifications that ran out of attempts.')
+def send_notifications(retry_failed):
+  """Send all due new-message notifications now."""
+  if notifier is None:
+    raise click.ClickException('NOTIFY_EMAIL is not set')
+  if retry_failed:
+    with db.engine.begin() as connection:
+      connection.execute(
+          update(notification_outbox_table).where(
+              notification_outbox_table.c.next_attempt.is_(None)).values(
+                  attempts=0, next_attempt=datetime.now()))
+  total = 0
+  while claimed := notifier.send_due():
+    total += claimed
+  click.echo(f"Processed {total} notifications")
+
+
+# Webhooks
+WEBHOOK_EVENTS = ('project.created', 'project.updated', 'project.deleted',
+                  'message.created')
+
+
+class WebhookEndpoint:
+
+  def __init__(self, url, secret=None, events=WEBHOOK_EVENTS):
+    unknown = set(events) - set(WEBHOOK_EVENTS)
+    if unknown:
+      raise RuntimeError(
+          f"Unknown webhook events for {url}: {', '.join(sorted(unknown))}")
+    self.url = url
+    self.secret = secret
+    self.events = frozenset(events)
+    self.pending = []
+    self.flush_at = None
+    # (batch, attempt) whose backoff has elapsed
+    self.retries = deque()
+    self.in_flight = 0
+
+
+class WebhookDispatcher(BackgroundThread):
+  # emit() only appends to the endpoint's pending list. A dispatcher thread
+  # hands batches to a bounded thread pool once they are full or old enough,
+  # never running more than `concurrency` deliveries per endpoint, so a slow
+  # receiver holds at most that many workers and never delays a request.
+
+  thread_name = 'webhook-dispatcher'
+
+  def __init__(self, endpoints, workers, concurrency, batch_seconds,
+               batch_size, max_attempts, queue_size):
+    # The condition's lock is reentrant, so emit() can start the thread
+    # while holding it
+    self.condition = threading.Condition()
+    super().__init__(self.condition)
+    self.endpoints = endpoints
+    self.workers = workers
+    self.concurrency = concurrency
+    self.batch_seconds = batch_seconds
+    self.batch_size = batch_size
+    self.max_attempts = max_attempts
+    self.queue_size = queue_size
+    self.queued = 0
+    # Heap of (due, sequence, endpoint, batch, attempt) backing off
+    self.backoff = []
+    self.sequence = 0
+
+  def emit(self, event_type, data):
+    event = {
+        'id': str(uuid4()),
+        'type': event_type,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'data': data,
+    }
+    with self.condition:
+      self.start()
+      for endpoint in self.endpoints:
+        if event_type not in endpoint.events:
+          continue
+        if self.queued >= self.queue_size:
+          metrics.inc('webhook_events_total', result='dropped')
+          continue
+        endpoint.pending.append(event)
+        self.queued += 1
+        if endpoint.flush_at is None:
+          endpoint.flush_at = time.monotonic() + self.batch_seconds
+          self.condition.notify()
+        elif len(endpoint.pending) >= self.batch_size:
+          self.condition.notify()
+
+  def before_start(self):
+    # Pending events carry over into a forked worker; the pool does not
+    self.executor = ThreadPoolExecutor(self.workers,
+                                       thread_name_prefix='webhook')
+
+  def run(self):
+    with self.condition:
+      while True:
+        now = time.monotonic()
+        self.dispatch(now)
+        deadlines = [
+            endpoint.flush_at for endpoint in self.endpoints
+            if endpoint.pending and endpoint.in_flight < self.concurrency
+        ]
+        if self.backoff:
+          deadlines.append(self.backoff[0][0])
+        # Otherwise a finished delivery or a new event wakes the thread
+        timeout = max(0, min(deadlines) - now) if deadlines else None
+        self.condition.wait(timeout)
+
+  def dispatch(self, now):
+    while self.backoff and self.backoff[0][0] <= now:
+      _, _, endpoint, batch, attempt = heapq.heappop(self.backoff)
+      endpoint.retries.append((batch, attempt))
+    for endpoint in self.endpoints:
+      while endpoint.in_flight < self.concurrency:
+        if endpoint.retries:
+          batch, attempt = endpoint.retries.popleft()
+        elif endpoint.pending and (len(endpoint.pending) >= self.batch_size
+                                   or endpoint.flush_at <= now):
+          batch = endpoint.pending[:self.batch_size]
+          del endpoint.pending[:self.batch_size]
+          attempt = 1
+        else:
+          break
+        endpoint.in_flight += 1
+        self.executor.submit(self.deliver, endpoint, batch, attempt)
+      if not endpoint.pending:
+        endpoint.flush_at = None
+
+  def deliver(self, endpoint, batch, attempt):
+    ok, retry = post_webhook(endpoint, {'events': batch},
+                             app.config['WEBHOOK_TIMEOUT'])
+    metrics.inc('webhook_requests_total',
+                endpoint=endpoint.url,
+                outcome='ok' if ok else 'error')
+    with self.condition:
+      endpoint.in_flight -= 1
+      if not ok and retry and attempt < self.max_attempts:
+        delay = min(2**attempt, 300) * (0.5 + random.random() / 2)
+        self.sequence += 1
+        heapq.heappush(self.backoff, (time.monotonic() + delay, self.sequence,
+                                      endpoint, batch, attempt + 1))
+      else:
+        self.queued -= len(batch)
+        if not ok:
+          app.logger.error('Dropping %d webhook events for %s', len(batch),
+                           endpoint.url)
+        metrics.inc('webhook_events_total',
+                    len(batch),
+                    result='delivered' if ok else 'failed')
+      self.condition.notify()
+
+
+def post_webhook(endpoint, payload, timeout):
+  # Returns (delivered, worth retrying)
+  import urllib.error
+  import urllib.request
+
+  body = json.dumps(payload, separators=(',', ':')).encode()
+  headers = {'Content-Type': 'application/json'}
+  if endpoint.secret:
+    signature = hmac.new(endpoint.secret.encode(), body,
+                         hashlib.sha256).hexdigest()
+    headers['X-Webhook-Signature'] = f"sha256={signature}"
+  webhook_request = urllib.request.Request(endpoint.url,
+                                           data=body,
+                                           headers=headers,
+                                           method='POST')
+  try:
+    with urllib.request.urlopen(webhook_request, timeout=timeout) as response:
+      response.read()
+    return True, False
+  except urllib.error.HTTPError as e:
+    app.logger.warning('Webhook %s answered %d', endpoint.url, e.code)
+    # Other client errors will not go away by sending the same body again
+    return False, e.code >= 500 or e.code in (408, 429)
+  except OSError as e:
+    app.logger.warning('Webhook %s failed: %s', endpoint.url, e)
+    return False, True
+
+
+def project_event_data(slug, title, description, version):
+  # Inline images can be megabytes, so receivers fetch them from the page
+  return {
+      'slug': slug,
+      'title': title,
+      'description': description,
+      'version': version,
+      'url': url_for('show_project', slug=slug, _external=True),
+  }
+
+
+def contact_messages_stored(rows):
+  # Takes the rows insert_contact_messages wrote, so duplicates and replays
+  # of rows stored earlier are not announced again
+  if webhooks is None:
+    return
+  for row in rows:
+    webhooks.emit(
+        'message.created', {
+            'id': row['id'],
+            'first_name': row['first_name'],
+            'last_name': row['last_name'],
+            'email': row['email'],
+            'subject': row['subject'],
+            'message': row['message'],
+            'timestamp': row['timestamp'].isoformat(),
+        })
+
+
+webhooks = None
+if app.config['WEBHOOKS']:
+  webhooks = WebhookDispatcher(
+      [WebhookEndpoint(**endpoint) for endpoint in app.config['WEBHOOKS']],
+      app.config['WEBHOOK_WORKERS'], app.config['WEBHOOK_CONCURRENCY'],
+      app.config['WEBHOOK_BATCH_MS'] / 1000, app.config['WEBHOOK_BATCH_SIZE'],
+      app.config['WEBHOOK_MAX_ATTEMPTS'], app.config['WEBHOOK_QUEUE_SIZE'])
+
+
+# Rate Limiting
+def refill_bucket(tokens, updated, now, burst, rate):
+  # Returns the tokens left and, when none could be taken, the seconds until
+  # the next one
+  tokens = min(burst, tokens + (now - updated) * rate)
+  if tokens >= 1:
+    return tokens - 1, 0
+  return tokens, (1 - tokens) / rate
+
+
+class MemoryTokenBuckets:
+
+  def __init__(self, burst, rate, max_keys=100000):
+    self.burst = burst
+    self.rate = rate
+    self.max_keys = max_keys
+    # In order of last use, so the first key is the least recently seen
+    self.buckets = {}
+    self.lock = threading.Lock()
+
+  def take(self, key):
+    now = time.monotonic()
+    with self.lock:
+      tokens, updated = self.buckets.pop(key, (self.burst, now))
+      tokens, retry_after = refill_bucket(tokens, updated, now, self.burst,
+                                          self.rate)
+      self.buckets[key] = (tokens, now)
+      if len(self.buckets) > self.max_keys:
+        del self.buckets[next(iter(self.buckets))]
+    return retry_after
+
+
+class SQLiteTokenBuckets:
+  # Shared by all workers on the host. The buckets live in their own small
+  # database so that checking them never waits for the main write lock, and
+  # they are not worth an fsync. Request threads take turns on one
+  # connection per process; a take is far shorter than opening a connection.
+
+  def __init__(self, path, burst, rate):
+    self.path = path
+    self.burst = burst
+    self.rate = rate
+    self.lock = threading.Lock()
+    self.pid = None
+    self.sqlite = None
+    self.takes = 0
+
+  def connection(self):
+    # Called with self.lock held
+    if self.pid != os.getpid():
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      connection = sqlite3.connect(self.path,
+                                   timeout=1,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+      connection.execute('PRAGMA journal_mode = WAL')
+      connection.execute('PRAGMA synchronous = OFF')
+      connection.execute('CREATE TABLE IF NOT EXISTS token_buckets ('
+                         'key TEXT PRIMARY KEY, tokens REAL, updated REAL'
+                         ') WITHOUT ROWID')
+      self.sqlite = connection
+      self.pid = os.getpid()
+    return self.sqlite
+
+  def take(self, key):
+    with self.lock:
+      now = time.time()
+      try:
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+          row = connection.execute(
+              'SELECT tokens, updated FROM token_buckets WHERE key = ?',
+              (key, )).fetchone()
+          tokens, updated = row or (self.burst, now)
+          tokens, retry_after = refill_bucket(tokens, updated, now, self.burst,
+                                              self.rate)
+          connection.execute('INSERT OR REPLACE INTO token_buckets VALUES '
+                             '(?, ?, ?)', (key, tokens, now))
+          self.takes += 1
+          if self.takes % 1000 == 0:
+            # Buckets untouched for this long are full again anyway
+            connection.execute('DELETE FROM token_buckets WHERE updated < ?',
+                               (now - self.burst / self.rate, ))
+          connection.execute('COMMIT')
+        except BaseException:
+          connection.execute('ROLLBACK')
+          raise
+      except sqlite3.Error:
+        # A broken limiter must not take the contact form down with it
+        app.logger.exception('Rate limit check failed; allowing the request')
+        return 0
+      return retry_after
+
+
+if app.config['PROXY_FIX_X_FOR']:
+  app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+contact_rate_limiter = None
+if app.config['CONTACT_RATE_LIMIT'] == 'memory':
+  contact_rate_limiter = MemoryTokenBuckets(
+      app.config['CONTACT_RATE_BURST'],
+      app.config['CONTACT_RATE_PER_MINUTE'] / 60)
+elif app.config['CONTACT_RATE_LIMIT'] == 'sqlite':
+  contact_rate_limiter = SQLiteTokenBuckets(
+      app.config['CONTACT_RATE_LIMIT_DB']
+      or os.path.join(app.instance_path, 'rate_limits.db'),
+      app.config['CONTACT_RATE_BURST'],
+      app.config['CONTACT_RATE_PER_MINUTE'] / 60)
+elif app.config['CONTACT_RATE_LIMIT'] is not None:
+  raise RuntimeError(
+      f"Unknown CONTACT_RATE_LIMIT {app.config['CONTACT_RATE_LIMIT']!r}")
+
+
+@app.before_request
+def limit_contact_rate():
+  # Runs before the form is parsed, so a rejected post costs one bucket check
+  if (contact_rate_limiter is None or request.method != 'POST'
+      or request.endpoint != 'contact'):
+    return None
+  retry_after = contact_rate_limiter.take(request.remote_addr or 'unknown')
+  if not retry_after:
+    return None
+  metrics.inc('http_rate_limited_total', endpoint=request.endpoint)
+  return app.response_class('Too many messages; please try again later.\n',
+                            status=429,
+                            mimetype='text/plain',
+                            headers={'Retry-After': str(math.ceil(retry_after))})
+
+
+# Maintenance
+def analyze_database():
+  # A bounded sample per index is enough for the query planner and keeps
+  # ANALYZE quick on large tables
+  with db.engine.connect() as connection:
+    connection.exec_driver_sql('PRAGMA analysis_limit = 1000')
+    try:
+      connection.exec_driver_sql('ANALYZE')
+    finally:
+      connection.exec_driver_sql('PRAGMA analysis_limit = 0')
+
+
+def checkpoint_wal():
+  with db.engine.connect() as connection:
+    _, frames, checkpointed = connection.exec_driver_sql(
+        'PRAGMA wal_checkpoint(TRUNCATE)').one()
+  if frames < 0:
+    return 'not in WAL mode'
+  return f"{checkpointed} of {frames} frames checkpointed"
+
+
+def vacuum_incrementally():
+  pages = app.config['MAINTENANCE_VACUUM_PAGES']
+  with db.engine.connect() as connection:
+    if connection.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+      return 'auto_vacuum is not INCREMENTAL'
+    free = connection.exec_driver_sql('PRAGMA freelist_count').scalar()
+    # Each step of the statement frees one page, and execute() only steps
+    # once when there are no result columns; executescript() runs it to the
+    # end
+    connection.connection.driver_connection.executescript(
+        f"PRAGMA incremental_vacuum({int(pages)})")
+  return f"{min(free, pages)} of {free} free pages released"
+
+
+def clean_up():
+  # Parked notifications of messages that were deleted or archived since,
+  # and run history past MAINTENANCE_HISTORY_DAYS
+  outbox = notification_outbox_table
+  runs = maintenance_runs_table
+  with db.engine.begin() as connection:
+    orphans = connection.execute(
+        delete(outbox).where(
+            outbox.c.message_id.not_in(select(
+                contact_messages_table.c.id)))).rowcount
+    history = connection.execute(
+        delete(runs).where(runs.c.started < datetime.now() - timedelta(
+            days=app.config['MAINTENANCE_HISTORY_DAYS']))).rowcount
+  return f"{orphans} orphaned notifications, {history} old runs deleted"
+
+
+def archive_old_messages():
+  if app.config['RETENTION_MONTHS'] is None:
+    return 'RETENTION_MONTHS is not set'
+  moved = archive_messages(archive_cutoff(app.config['RETENTION_MONTHS']))
+  return f"{sum(moved.values())} messages archived"
+
+
+MAINTENANCE_TASKS = {
+    'archive': archive_old_messages,
+    'cleanup': clean_up,
+    'analyze': analyze_database,
+    'vacuum': vacuum_incrementally,
+    'checkpoint': checkpoint_wal,
+}
+
+
+class MaintenanceScheduler(BackgroundThread):
+  # Every process runs a scheduler thread, but only the holder of the lease
+  # row runs tasks. The holder renews the lease on every check and before
+  # each task, so leadership stays put until it stops or dies.
+
+  thread_name = 'maintenance'
+
+  def __init__(self, schedule, interval, lease_seconds, max_in_flight):
+    super().__init__()
+    unknown = set(schedule) - set(MAINTENANCE_TASKS)
+    if unknown:
+      raise ValueError(
+          f"Unknown maintenance tasks: {', '.join(sorted(unknown))}")
+    self.schedule = {
+        name: seconds
+        for name, seconds in schedule.items() if seconds is not None
+    }
+    self.interval = interval
+    self.lease = timedelta(seconds=lease_seconds)
+    self.max_in_flight = max_in_flight
+    self.owner = None
+    self.leader = False
+
+  def before_start(self):
+    self.owner = (f"{socket.gethostname()}:{os.getpid()}:"
+                  f"{secrets.token_hex(4)}")
+    self.leader = False
+    atexit.register(self.release)
+
+  def run(self):
+    with app.app_context():
+      while True:
+        time.sleep(self.interval)
+        try:
+          self.run_due()
+        except Exception:
+          app.logger.exception('Maintenance failed')
+
+  def acquire(self):
+    # Takes the lease if it is free or lapsed, or renews our own; the
+    # upsert's WHERE makes this a single atomic statement
+    lease = maintenance_lease_table
+    now = datetime.now()
+    stmt = sqlite_insert(lease).values(name='maintenance',
+                                       owner=self.owner,
+                                       expires=now + self.lease)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[lease.c.name],
+        set_={
+            'owner': stmt.excluded.owner,
+            'expires': stmt.excluded.expires
+        },
+        where=(lease.c.owner == self.owner) | (lease.c.expires < now))
+    with db.engine.begin() as connection:
+      self.leader = connection.execute(stmt).rowcount == 1
+    return self.leader
+
+  def release(self):
+    if not self.leader:
+      return
+    # Lets another worker take over at once instead of when the lease lapses
+    lease = maintenance_lease_table
+    with app.app_context(), db.engine.begin() as connection:
+      connection.execute(
+          delete(lease).where(lease.c.name == 'maintenance',
+                              lease.c.owner == self.owner))
+    self.leader = False
+
+  def busy(self):
+    return metrics.get('http_requests_in_flight') > self.max_in_flight
+
+  def due(self):
+    runs = maintenance_runs_table
+    now = datetime.now()
+    due = []
+    with db.engine.connect() as connection:
+      for name, seconds in self.schedule.items():
+        last = connection.execute(
+            select(func.max(runs.c.started)).where(
+                runs.c.task == name)).scalar()
+        if last is None or last + timedelta(seconds=seconds) <= now:
+          due.append(name)
+    return due
+
+  def run_due(self):
+    if self.busy():
+      metrics.inc('maintenance_deferred_total')
+      return
+    if not self.acquire():
+      return
+    for name in self.due():
+      if self.busy():
+        metrics.inc('maintenance_deferred_total')
+        return
+      # A long task must not outlast the lease it started under
+      if not self.acquire():
+        return
+      self.run_task(name)
+
+  def run_task(self, name):
+    started = datetime.now()
+    timer = time.perf_counter()
+    try:
+      detail = MAINTENANCE_TASKS[name]()
+      status = 'ok'
+    except Exception as e:
+      app.logger.exception('Maintenance task %s failed', name)
+      detail = f"{type(e).__name__}: {e}"
+      status = 'error'
+    duration = time.perf_counter() - timer
+    metrics.inc('maintenance_runs_total', task=name, status=status)
+    metrics.observe('maintenance_run_duration_seconds', duration, task=name)
+    with db.engine.begin() as connection:
+      connection.execute(maintenance_runs_table.insert().values(
+          task=name,
+          owner=self.owner,
+          started=started,
+          duration_seconds=duration,
+          status=status,
+          detail=detail))
+    return status, duration, detail
+
+
+maintenance = None
+if app.config['MAINTENANCE']:
+  maintenance = MaintenanceScheduler(app.config['MAINTENANCE_SCHEDULE'],
+                                     app.config['MAINTENANCE_CHECK_SECONDS'],
+                                     app.config['MAINTENANCE_LEASE_SECONDS'],
+                                     app.config['MAINTENANCE_MAX_IN_FLIGHT'])
+
+  @app.before_request
+  def start_maintenance():
+    maintenance.start()
+
+
+@app.cli.command('maintenance')
+@click.argument('tasks', nargs=-1, type=click.Choice(list(MAINTENANCE_TASKS)))
+def maintenance_command(tasks):
+  """Run maintenance tasks now (default: the ones that are due)."""
+  init_db()
+  scheduler = MaintenanceScheduler(app.config['MAINTENANCE_SCHEDULE'],
+                                   app.config['MAINTENANCE_CHECK_SECONDS'],
+                                   app.config['MAINTENANCE_LEASE_SECONDS'],
+                                   app.config['MAINTENANCE_MAX_IN_FLIGHT'])
+  scheduler.owner = f"{socket.gethostname()}:{os.getpid()}:cli"
+  if not scheduler.acquire():
+    raise click.ClickException('Another worker holds the maintenance lease')
+  try:
+    for name in tasks or scheduler.due():
+      status, duration, detail = scheduler.run_task(name)
+      click.echo(f"{name}: {status} in {duration:.3f}s"
+                 f"{f' ({detail})' if detail else ''}")
+  finally:
+    scheduler.release()
+
+
 # Public Website Routes
 @app.get('/')
 def home():
@@ -237,14 +3186,12 @@ def home():
 
 @app.get('/projects')
 def display_projects():
-  projects = get_projects()
-  return render_template("website/projects.html", projects=projects)
+  return stream_page("website/projects.html", projects=iter_projects())
 
 
 @app.get('/projects/<string:slug>')
 def show_project(slug):
-  projects = get_projects()
-  project = projects.get(slug)
+  project = get_project(slug)
   if not project:
     return 'Project not found', 404
   return render_template('website/view_project.html', project=project)
@@ -254,23 +3201,41 @@ def show_project(slug):
 def contact():
   current_time = datetime.now()
   if request.method == 'POST':
-    message_id = str(uuid4())
-    insert_stmt = contact_messages_table.insert().values(
-        id=message_id,
-        first_name=request.form.get('firstName'),
-        last_name=request.form.get('lastName'),
-        email=request.form.get('email'),
-        subject=request.form.get('subject'),
-        message=request.form.get('message'),
-        timestamp=current_time)
-    db.session.execute(insert_stmt)
-    db.session.commit()
+    email = request.form.get('email')
+    subject = request.form.get('subject')
+    message = request.form.get('message')
+    row = {
+        'id': str(uuid4()),
+        'first_name': request.form.get('firstName'),
+        'last_name': request.form.get('lastName'),
+        'email': email,
+        'subject': subject,
+        'message': message,
+        'timestamp': current_time,
+        'idempotency_key': request.form.get('idempotency_key', '')[:64]
+        or None,
+        'content_hash': contact_content_hash(email, subject, message,
+                                             current_time),
+    }
+    if contact_writer is not None:
+      try:
+        contact_writer.submit(row, app.config['CONTACT_WRITE_TIMEOUT'])
+      except TimeoutError:
+        abort(503)
+    else:
+      write_contact_messages([row])
     flash('Your message has been successfully sent!', 'success')
     return redirect(url_for('contact'))
-  return render_template("website/contact.html")
+  # Sent back with the post, so that a double submit of this form is stored
+  # once
+  return render_template("website/contact.html",
+                         idempotency_key=secrets.token_urlsafe(16))
+
+
+check_cache_policies()
 
+if app.config['TEMPLATE_PRELOAD']:
+  preload_templates()
 
 if __name__ == "__main__":
-  with app.app_context():
-    metadata.create_all(db.engine)
   app.run(host='0.0.0.0', port=81, debug=True)
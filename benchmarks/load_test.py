@@ -0,0 +1,336 @@
+"""Concurrent load test against the app under a real WSGI server.
+
+Run from the repository root:
+
+  python -m benchmarks.load_test --clients 32 --duration 30 \\
+      --mix browse=60,project=30,contact=8,edit=2
+
+A temporary database is filled with `flask generate-data`, the app is served
+by werkzeug on localhost (threaded, or with --processes N forked workers) and
+many client threads replay the request mix over real sockets. Unlike the test
+client this exposes lock contention, e.g. concurrent SQLite writes from
+/contact.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlencode
+
+from benchmarks.routes import ROOT, app_env, git_commit, percentile
+
+DEFAULT_MIX = 'browse=60,project=30,contact=8,edit=2'
+
+
+def scenarios(slugs):
+  # Each scenario returns (method, path, form)
+
+  def browse(_rng):
+    return 'GET', '/projects', None
+
+  def project(rng):
+    return 'GET', f"/projects/{rng.choice(slugs)}", None
+
+  def contact(rng):
+    n = rng.randrange(1000000)
+    return 'POST', '/contact', {
+        'firstName': 'Load',
+        'lastName': 'Test',
+        'email': f"load{n}@example.com",
+        'subject': f"Load test {n}",
+        'message': 'Sent by the load test harness',
+    }
+
+  def edit(rng):
+    return 'POST', f"/cms/projects/edit/{rng.choice(slugs)}", {
+        'title': f"Load test project {rng.randrange(1000000)}",
+        'description': 'Edited by the load test harness',
+    }
+
+  return {
+      'browse': browse,
+      'project': project,
+      'contact': contact,
+      'edit': edit,
+  }
+
+
+def parse_mix(text, available):
+  mix = {}
+  for part in text.split(','):
+    name, _, weight = part.partition('=')
+    name = name.strip()
+    if name not in available:
+      raise SystemExit(f"Unknown scenario {name!r}; choose from "
+                       f"{', '.join(available)}")
+    mix[name] = float(weight or 1)
+  if not any(mix.values()):
+    raise SystemExit('The mix needs at least one positive weight')
+  return mix
+
+
+def free_port(host):
+  with socket.socket() as s:
+    s.bind((host, 0))
+    return s.getsockname()[1]
+
+
+def wait_until_listening(host, port, server, timeout):
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    if server.poll() is not None:
+      raise SystemExit(f"Server exited with status {server.returncode}")
+    try:
+      socket.create_connection((host, port), timeout=1).close()
+      return
+    except OSError:
+      time.sleep(0.1)
+  raise SystemExit(f"Server did not start listening within {timeout}s")
+
+
+def request(host, port, method, path, form, timeout):
+  body = urlencode(form) if form is not None else None
+  headers = {'Accept-Encoding': 'gzip'}
+  if body is not None:
+    headers['Content-Type'] = 'application/x-www-form-urlencoded'
+  connection = http.client.HTTPConnection(host, port, timeout=timeout)
+  try:
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    size = len(response.read())
+    return response.status, size
+  finally:
+    connection.close()
+
+
+class Recorder:
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.samples = {}
+
+  def add(self, scenario, latency, status):
+    with self.lock:
+      self.samples.setdefault(scenario, []).append((latency, status))
+
+
+def run_client(host, port, mix, actions, recorder, stop, measure_from, rng,
+               timeout):
+  names = list(mix)
+  weights = [mix[name] for name in names]
+  while not stop.is_set():
+    scenario = rng.choices(names, weights)[0]
+    method, path, form = actions[scenario](rng)
+    started = time.perf_counter()
+    try:
+      status, _ = request(host, port, method, path, form, timeout)
+    except (OSError, http.client.HTTPException) as e:
+      status = type(e).__name__
+    if started >= measure_from:
+      recorder.add(scenario, time.perf_counter() - started, status)
+
+
+def summarize(samples, seconds):
+  latencies = [latency for latency, _ in samples]
+  statuses = {}
+  for _, status in samples:
+    statuses[str(status)] = statuses.get(str(status), 0) + 1
+  # Redirects are the normal answer to form posts; anything else that is not
+  # a 2xx/3xx (including connection failures) counts as an error
+  errors = sum(
+      1 for _, status in samples
+      if not isinstance(status, int) or not 200 <= status < 400)
+  cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else []
+  return {
+      'requests': len(samples),
+      'throughput_rps': round(len(samples) / seconds, 2),
+      'error_rate': round(errors / len(samples), 4) if samples else None,
+      'status': dict(sorted(statuses.items())),
+      'p50_ms': percentile(cuts, 50),
+      'p95_ms': percentile(cuts, 95),
+      'p99_ms': percentile(cuts, 99),
+      'mean_ms': round(statistics.fmean(latencies) * 1000, 3)
+      if latencies else None,
+  }
+
+
+def seed(env, args):
+  subprocess.run([
+      sys.executable, '-m', 'flask', '--app', 'app', 'generate-data',
+      '--projects',
+      str(args.projects), '--messages',
+      str(args.messages), '--max-image-size',
+      str(args.image_size), '--seed',
+      str(args.seed)
+  ],
+                 cwd=ROOT,
+                 env=env,
+                 check=True,
+                 stdout=subprocess.DEVNULL)
+
+
+def run_server(args):
+  from werkzeug.serving import run_simple
+
+  import app as app_module
+
+  run_simple(args.host,
+             args.port,
+             app_module.app,
+             threaded=args.processes == 1,
+             processes=args.processes,
+             use_reloader=False,
+             use_debugger=False)
+
+
+def run(args):
+  with tempfile.TemporaryDirectory() as directory:
+    database = os.path.join(directory, 'load.db')
+    env = app_env(database)
+    print(f"Seeding {args.projects} projects and {args.messages} messages",
+          file=sys.stderr)
+    seed(env, args)
+    with sqlite3.connect(database) as connection:
+      slugs = [row[0] for row in connection.execute('SELECT slug FROM projects')]
+    if not slugs:
+      raise SystemExit('The load test needs at least one project')
+
+    actions = scenarios(slugs)
+    mix = parse_mix(args.mix, actions)
+    port = args.port or free_port(args.host)
+    server = subprocess.Popen([
+        sys.executable, '-m', 'benchmarks.load_test', '--serve', '--host',
+        args.host, '--port',
+        str(port), '--processes',
+        str(args.processes)
+    ],
+                              cwd=ROOT,
+                              env=env,
+                              stderr=subprocess.DEVNULL)
+    try:
+      wait_until_listening(args.host, port, server, timeout=30)
+      print(
+          f"Running {args.clients} clients for {args.duration}s "
+          f"(+{args.warmup}s warm-up) against port {port}",
+          file=sys.stderr)
+      recorder = Recorder()
+      stop = threading.Event()
+      measure_from = time.perf_counter() + args.warmup
+      rng = random.Random(args.seed)
+      clients = [
+          threading.Thread(target=run_client,
+                           args=(args.host, port, mix, actions, recorder, stop,
+                                 measure_from,
+                                 random.Random(rng.getrandbits(64)),
+                                 args.timeout),
+                           daemon=True) for _ in range(args.clients)
+      ]
+      for client in clients:
+        client.start()
+      time.sleep(args.warmup + args.duration)
+      stop.set()
+      measured = time.perf_counter() - measure_from
+      for client in clients:
+        client.join()
+    finally:
+      server.terminate()
+      server.wait()
+
+  everything = [
+      sample for samples in recorder.samples.values() for sample in samples
+  ]
+  return {
+      'generated_at': datetime.now().isoformat(timespec='seconds'),
+      'commit': git_commit(),
+      'python': platform.python_version(),
+      'server': ('threaded' if args.processes == 1 else
+                 f"{args.processes} processes"),
+      'clients': args.clients,
+      'duration_seconds': round(measured, 3),
+      'projects': args.projects,
+      'messages': args.messages,
+      'image_size': args.image_size,
+      'mix': mix,
+      'seed': args.seed,
+      'overall': summarize(everything, measured),
+      'scenarios': {
+          name: summarize(recorder.samples.get(name, []), measured)
+          for name in mix
+      },
+  }
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--clients',
+                      type=int,
+                      default=16,
+                      help='concurrent client threads')
+  parser.add_argument('--duration',
+                      type=float,
+                      default=30,
+                      help='measured seconds')
+  parser.add_argument('--warmup',
+                      type=float,
+                      default=3,
+                      help='unmeasured seconds before the measurement')
+  parser.add_argument('--mix',
+                      default=DEFAULT_MIX,
+                      help='weighted scenarios (default: %(default)s)')
+  parser.add_argument('--processes',
+                      type=int,
+                      default=1,
+                      help='forked server processes; 1 serves from threads')
+  parser.add_argument('--projects', type=int, default=1000)
+  parser.add_argument('--messages', type=int, default=10000)
+  parser.add_argument('--image-size',
+                      type=int,
+                      default=8192,
+                      help='largest inline project image in bytes')
+  parser.add_argument('--timeout',
+                      type=float,
+                      default=30,
+                      help='per-request socket timeout in seconds')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port',
+                      type=int,
+                      default=0,
+                      help='server port (default: any free port)')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--output',
+                      default='load-test-results.json',
+                      help='where to write the JSON report')
+  parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  args = parse_args(argv)
+  if args.serve:
+    run_server(args)
+    return
+
+  report = run(args)
+  with open(args.output, 'w') as f:
+    json.dump(report, f, indent=2)
+  overall = report['overall']
+  print(
+      f"{overall['requests']} requests, {overall['throughput_rps']} req/s, "
+      f"error rate {overall['error_rate']}, p99 {overall['p99_ms']} ms",
+      file=sys.stderr)
+  print(f"Wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
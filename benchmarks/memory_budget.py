@@ -0,0 +1,165 @@
+"""Per-route peak memory checked against stored budgets.
+
+Run from the repository root:
+
+  python -m benchmarks.memory_budget            # exit 1 if over budget
+  python -m benchmarks.memory_budget --update   # re-record the budgets
+
+Every route is requested once against each seeded dataset listed in
+memory_budgets.json, with tracemalloc measuring the peak allocated during the
+request. A route fails when its peak exceeds the recorded budget, which is the
+peak measured at --update time plus --headroom (and at least --slack bytes, so
+that small routes do not fail on noise).
+"""
+import argparse
+import json
+import os
+import sys
+
+from benchmarks.routes import (
+    datasets,
+    peak_memory,
+    route_cases,
+    run_dataset_worker,
+    seed,
+)
+
+BUDGETS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'memory_budgets.json')
+
+
+def run_worker(args):
+  import app as app_module
+
+  seed(app_module, args.size, args.with_images, args.image_size, args.seed)
+  cases = route_cases(app_module, 2)
+  missing = set(app_module.app.view_functions) - set(cases)
+  if missing:
+    raise SystemExit(f"No benchmark case for: {', '.join(sorted(missing))}")
+
+  client = app_module.app.test_client()
+  peaks = {}
+  for endpoint, run in cases.items():
+    # Warm up first so that one-off template compilation is not counted
+    warmup = run(client)
+    if warmup is not None:
+      warmup.close()
+    peaks[endpoint] = peak_memory(run, client)
+  return peaks
+
+
+def measure_dataset(size, images, image_size, seed_value):
+  return run_dataset_worker(
+      'benchmarks.memory_budget', size, images,
+      ['--image-size', str(image_size), '--seed',
+       str(seed_value)])
+
+
+def dataset_name(size, images):
+  return f"{size}-{'images' if images else 'plain'}"
+
+
+def update(args):
+  results = {}
+  for size, images in datasets(args.sizes, args.images):
+    name = dataset_name(size, images)
+    print(f"Measuring {name}", file=sys.stderr)
+    peaks = measure_dataset(size, images, args.image_size, args.seed)
+    results[name] = {
+        'size': size,
+        'images': images,
+        'budgets': {
+            endpoint: int(max(peak * (1 + args.headroom), peak + args.slack))
+            for endpoint, peak in sorted(peaks.items()) if peak is not None
+        },
+    }
+  with open(args.budgets, 'w') as f:
+    json.dump(
+        {
+            'image_size': args.image_size,
+            'seed': args.seed,
+            'headroom': args.headroom,
+            'slack': args.slack,
+            'datasets': results,
+        },
+        f,
+        indent=2)
+    f.write('\n')
+  print(f"Wrote {args.budgets}", file=sys.stderr)
+
+
+def check(args):
+  with open(args.budgets) as f:
+    stored = json.load(f)
+  failures = []
+  for name, dataset in stored['datasets'].items():
+    print(f"Measuring {name}", file=sys.stderr)
+    peaks = measure_dataset(dataset['size'], dataset['images'],
+                            stored['image_size'], stored['seed'])
+    for endpoint, peak in sorted(peaks.items()):
+      if peak is None:
+        continue
+      budget = dataset['budgets'].get(endpoint)
+      if budget is None:
+        failures.append(f"{name} {endpoint}: no budget recorded")
+      elif peak > budget:
+        failures.append(f"{name} {endpoint}: peak {peak} bytes exceeds "
+                        f"budget {budget} bytes ({peak / budget - 1:+.0%})")
+      else:
+        print(f"  {endpoint}: {peak} / {budget} bytes", file=sys.stderr)
+  for failure in failures:
+    print(f"FAIL {failure}", file=sys.stderr)
+  return 1 if failures else 0
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--update',
+                      action='store_true',
+                      help='re-record the budgets instead of checking them')
+  parser.add_argument('--budgets',
+                      default=BUDGETS,
+                      help='budget file (default: %(default)s)')
+  parser.add_argument('--sizes',
+                      default='1000',
+                      help='with --update: comma-separated row counts')
+  parser.add_argument('--images',
+                      choices=('with', 'without', 'both'),
+                      default='both',
+                      help='with --update: seed projects with inline images')
+  parser.add_argument('--image-size',
+                      type=int,
+                      default=65536,
+                      help='with --update: largest inline image in bytes')
+  parser.add_argument('--headroom',
+                      type=float,
+                      default=0.25,
+                      help='with --update: allowed growth over the measured '
+                      'peak (default: %(default)s)')
+  parser.add_argument('--slack',
+                      type=int,
+                      default=65536,
+                      help='with --update: smallest allowed growth in bytes '
+                      '(default: %(default)s)')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+  parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+  parser.add_argument('--with-images',
+                      action='store_true',
+                      help=argparse.SUPPRESS)
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  args = parse_args(argv)
+  if args.worker:
+    json.dump(run_worker(args), sys.stdout)
+    return
+  if args.update:
+    update(args)
+    return
+  sys.exit(check(args))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,363 @@
+"""Route benchmarks against freshly seeded SQLite databases.
+
+Run from the repository root:
+
+  python -m benchmarks.routes --sizes 1000,10000 --output results.json
+
+Each dataset (number of projects and messages, with or without inline
+images) is seeded into its own temporary database and measured in a separate
+process, so the results do not depend on what ran before.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMAGE_MODES = {'with': [True], 'without': [False], 'both': [False, True]}
+
+
+def app_env(database):
+  # Environment for an app process on a temporary database. Everything the
+  # app writes goes into the database's directory, so nothing is replayed
+  # into or appended to the developer's own instance.
+  directory = os.path.dirname(database)
+  env = dict(os.environ)
+  env['FLASK_SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{database}"
+  env['FLASK_CONTACT_SPOOL_FILE'] = os.path.join(directory,
+                                                 'contact_spool.jsonl')
+  env['FLASK_ACCESS_LOG_FILE'] = os.path.join(directory, 'access.log')
+  # Every client shares one address, so the contact rate limit would reject
+  # most posts
+  env['FLASK_CONTACT_RATE_LIMIT'] = 'null'
+  # Scheduled ANALYZE, vacuum or archiving would land at a random point of
+  # the run
+  env['FLASK_MAINTENANCE'] = 'false'
+  return env
+
+
+def datasets(sizes, images):
+  # (size, images) pairs for a comma-separated --sizes and an --images mode
+  for size in (int(size) for size in sizes.split(',')):
+    for with_images in IMAGE_MODES[images]:
+      yield size, with_images
+
+
+def run_dataset_worker(module, size, images, options):
+  # Seeds and measures one dataset in a fresh process on its own database,
+  # which prints its result as JSON
+  with tempfile.TemporaryDirectory() as directory:
+    command = [
+        sys.executable, '-m', module, '--worker', '--size',
+        str(size), *options
+    ]
+    if images:
+      command.append('--with-images')
+    result = subprocess.run(command,
+                            cwd=ROOT,
+                            env=app_env(os.path.join(directory, 'app.db')),
+                            check=True,
+                            stdout=subprocess.PIPE)
+  return json.loads(result.stdout)
+
+def seed(app_module, size, images, image_size, seed_value):
+  rng = random.Random(seed_value)
+  with app_module.app.app_context():
+    app_module.init_db()
+    with app_module.db.engine.begin() as connection:
+      app_module.generate_projects(connection,
+                                   size,
+                                   rng,
+                                   image_ratio=1.0 if images else 0.0,
+                                   max_image_size=image_size,
+                                   batch_size=10000)
+      app_module.generate_messages(connection,
+                                   size,
+                                   rng,
+                                   years=5,
+                                   batch_size=10000)
+    # The oldest year goes to the monthly archives, as with retention on
+    app_module.archive_messages(app_module.archive_cutoff(48))
+
+
+def route_cases(app_module, requests_per_route):
+  # One case per endpoint. Destructive cases get their own pool of rows so
+  # that every request hits an existing one.
+  with app_module.app.app_context():
+    db = app_module.db
+    slugs = db.session.execute(
+        app_module.select(app_module.projects_table.c.slug).limit(
+            requests_per_route * 2 + 2)).scalars().all()
+    message_ids = db.session.execute(
+        app_module.select(app_module.contact_messages_table.c.id).limit(
+            requests_per_route * 3 + 3)).scalars().all()
+    archived = None
+    months = app_module.archive_months()
+    if months:
+      with app_module.attached_archive(months[0]) as connection:
+        archived_id = connection.execute(
+            app_module.select(
+                app_module.archived_messages_table.c.id).limit(1)).scalar()
+      archived = f"{months[0]:%Y-%m}/{archived_id}"
+  if not slugs or not message_ids or archived is None:
+    raise SystemExit('Datasets need at least one project, one message and '
+                     'one archived message')
+  slug, message_id = slugs[0], message_ids[0]
+  deletable_slugs = iter(slugs[1:])
+  deletable_ids = iter(message_ids[1:])
+  project_form = {'title': 'Benchmark project', 'description': 'Benchmark'}
+
+  sent = itertools.count()
+
+  def post_contact(client):
+    # A repeated form is dropped as a duplicate, so every post differs
+    n = next(sent)
+    return client.post('/contact',
+                       data={
+                           'firstName': 'Bench',
+                           'lastName': 'Mark',
+                           'email': f"bench{n}@example.com",
+                           'subject': f"Benchmark {n}",
+                           'message': f"Benchmark message body {n}",
+                       })
+
+  def get(url):
+    return lambda client: client.get(url)
+
+  def delete_next(url_format, pool):
+
+    def run(client):
+      key = next(pool, None)
+      if key is None:
+        return None
+      return client.post(url_format.format(key))
+
+    return run
+
+  def bulk_delete_next(pool):
+
+    def run(client):
+      key = next(pool, None)
+      if key is None:
+        return None
+      return client.post('/cms/inbox/bulk',
+                         data={
+                             'action': 'delete',
+                             'scope': 'selected',
+                             'ids': [key]
+                         })
+
+    return run
+
+  return {
+      'home': get('/'),
+      'display_projects': get('/projects'),
+      'show_project': get(f"/projects/{slug}"),
+      'contact': post_contact,
+      'cms_dashboard': get('/cms'),
+      'cms_inbox': get('/cms/inbox'),
+      'view_message': get(f"/cms/inbox/view/{message_id}"),
+      'delete_message': delete_next('/cms/inbox/delete/{}', deletable_ids),
+      'bulk_messages': bulk_delete_next(deletable_ids),
+      'cms_projects': get('/cms/projects'),
+      'add_project':
+      lambda client: client.post('/cms/projects/add', data=project_form),
+      'view_project': get(f"/cms/projects/{slug}"),
+      'edit_project':
+      lambda client: client.post(f"/cms/projects/edit/{slug}",
+                                 data=project_form),
+      'delete_project': delete_next('/cms/projects/delete/{}',
+                                    deletable_slugs),
+      'cms_archive': get('/cms/archive?subject=a'),
+      'view_archived_message': get(f"/cms/archive/{archived}"),
+      'static': get('/static/css/style.css'),
+      'metrics_endpoint': get('/metrics'),
+  }
+
+
+class QueryCounter:
+  # Counted with an engine event rather than read from Server-Timing, which
+  # is sent before a streamed page has run its queries
+
+  def __init__(self):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    self.count = 0
+    event.listen(Engine, 'after_cursor_execute', self.increment)
+
+  def increment(self, *_args):
+    self.count += 1
+
+
+def percentile(cuts, p):
+  return round(cuts[p - 1] * 1000, 3) if cuts else None
+
+
+def measure(run, client, requests_per_route, query_counter):
+  latencies = []
+  queries = []
+  statuses = {}
+  for _ in range(requests_per_route):
+    queries_before = query_counter.count
+    started = time.perf_counter()
+    response = run(client)
+    if response is None:
+      break
+    response.get_data()
+    response.close()
+    latencies.append(time.perf_counter() - started)
+    queries.append(query_counter.count - queries_before)
+    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+  cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else []
+  return {
+      'requests': len(latencies),
+      'status': {str(code): n
+                 for code, n in sorted(statuses.items())},
+      'p50_ms': percentile(cuts, 50),
+      'p95_ms': percentile(cuts, 95),
+      'p99_ms': percentile(cuts, 99),
+      'mean_ms': round(statistics.fmean(latencies) * 1000, 3)
+      if latencies else None,
+      'queries_per_request': round(statistics.fmean(queries), 2)
+      if queries else None,
+  }
+
+
+def peak_memory(run, client):
+  tracemalloc.start()
+  try:
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    response = run(client)
+    if response is None:
+      return None
+    # Chunks are dropped as they arrive, so streamed pages are measured at
+    # their working set rather than their full size
+    for _chunk in response.response:
+      pass
+    response.close()
+    return tracemalloc.get_traced_memory()[1] - baseline
+  finally:
+    tracemalloc.stop()
+
+
+def run_worker(args):
+  import app as app_module
+
+  started = time.perf_counter()
+  seed(app_module, args.size, args.with_images, args.image_size, args.seed)
+  seed_seconds = time.perf_counter() - started
+
+  cases = route_cases(app_module, args.requests)
+  missing = set(app_module.app.view_functions) - set(cases)
+  if missing:
+    raise SystemExit(f"No benchmark case for: {', '.join(sorted(missing))}")
+
+  query_counter = QueryCounter()
+  client = app_module.app.test_client()
+  routes = {}
+  for endpoint, run in cases.items():
+    # One unmeasured request warms the template and statement caches
+    warmup = run(client)
+    if warmup is not None:
+      warmup.close()
+    routes[endpoint] = measure(run, client, args.requests, query_counter)
+    routes[endpoint]['peak_memory_bytes'] = peak_memory(run, client)
+  return {
+      'projects': args.size,
+      'messages': args.size,
+      'images': args.with_images,
+      'seed_seconds': round(seed_seconds, 3),
+      'routes': routes,
+  }
+
+
+def run_dataset(size, images, args):
+  return run_dataset_worker('benchmarks.routes', size, images, [
+      '--requests',
+      str(args.requests), '--image-size',
+      str(args.image_size), '--seed',
+      str(args.seed)
+  ])
+
+
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                          cwd=ROOT,
+                          check=True,
+                          capture_output=True,
+                          text=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--sizes',
+                      default='1000,10000,100000',
+                      help='comma-separated row counts for projects and '
+                      'messages (default: %(default)s)')
+  parser.add_argument('--images',
+                      choices=('with', 'without', 'both'),
+                      default='both',
+                      help='seed projects with inline images')
+  parser.add_argument('--image-size',
+                      type=int,
+                      default=8192,
+                      help='largest inline image in bytes')
+  parser.add_argument('--requests',
+                      type=int,
+                      default=50,
+                      help='measured requests per route')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--output',
+                      default='benchmark-results.json',
+                      help='where to write the JSON report')
+  parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+  parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+  parser.add_argument('--with-images',
+                      action='store_true',
+                      help=argparse.SUPPRESS)
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  args = parse_args(argv)
+  if args.worker:
+    json.dump(run_worker(args), sys.stdout)
+    return
+
+  results = []
+  for size, images in datasets(args.sizes, args.images):
+    print(f"Benchmarking {size} rows, images={images}", file=sys.stderr)
+    results.append(run_dataset(size, images, args))
+
+  report = {
+      'generated_at': datetime.now().isoformat(timespec='seconds'),
+      'commit': git_commit(),
+      'python': platform.python_version(),
+      'requests_per_route': args.requests,
+      'image_size': args.image_size,
+      'seed': args.seed,
+      'datasets': results,
+  }
+  with open(args.output, 'w') as f:
+    json.dump(report, f, indent=2)
+  print(f"Wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
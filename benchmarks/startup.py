@@ -0,0 +1,149 @@
+"""Cold-start timings: interpreter start, `import app` and the first request.
+
+Run from the repository root:
+
+  python -m benchmarks.startup --runs 10 --output startup.json
+
+Each run is a fresh interpreter started with `-X importtime` against an empty
+temporary database, so the first request also pays for schema creation. The
+report lists median timings and the imports that contribute most to
+`import app`.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.routes import ROOT, app_env, git_commit
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/')
+response.close()
+served = time.perf_counter()
+print(json.dumps({'status': response.status_code,
+                  'import_ms': (imported - started) * 1000,
+                  'first_request_ms': (served - imported) * 1000}))
+"""
+
+
+def parse_importtime(stderr):
+  # Lines look like "import time:  self [us] | cumulative | <indent>name";
+  # the indentation gives the nesting depth
+  imports = []
+  for line in stderr.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    self_us, cumulative_us, name = line[len('import time:'):].split('|')
+    imports.append({
+        'module': name.strip(),
+        'depth': (len(name) - len(name.lstrip()) - 1) // 2,
+        'self_us': int(self_us),
+        'cumulative_us': int(cumulative_us),
+    })
+  return imports
+
+
+def direct_imports(imports):
+  # Modules imported by app.py itself are one level deeper than app, and
+  # are listed before it
+  result = {}
+  for entry in imports:
+    if entry['module'] == 'app':
+      break
+    if entry['depth'] == 1:
+      result[entry['module']] = entry['cumulative_us']
+  return result
+
+
+def run_once(env):
+  started = time.perf_counter()
+  result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE],
+                          cwd=ROOT,
+                          env=env,
+                          check=True,
+                          capture_output=True,
+                          text=True)
+  wall_ms = (time.perf_counter() - started) * 1000
+  probe = json.loads(result.stdout.strip().splitlines()[-1])
+  imports = parse_importtime(result.stderr)
+  return wall_ms, probe, imports
+
+
+def run(args):
+  walls, import_ms, first_request_ms, statuses = [], [], [], set()
+  selfs, directs = {}, {}
+  for i in range(args.runs):
+    with tempfile.TemporaryDirectory() as directory:
+      wall_ms, probe, imports = run_once(
+          app_env(os.path.join(directory, 'startup.db')))
+    walls.append(wall_ms)
+    import_ms.append(probe['import_ms'])
+    first_request_ms.append(probe['first_request_ms'])
+    statuses.add(probe['status'])
+    for entry in imports:
+      selfs.setdefault(entry['module'], []).append(entry['self_us'])
+    for module, cumulative in direct_imports(imports).items():
+      directs.setdefault(module, []).append(cumulative)
+    print(f"Run {i + 1}: {wall_ms:.1f} ms", file=sys.stderr)
+
+  def median_ms(values):
+    return round(statistics.median(values) / 1000, 3)
+
+  def top(samples):
+    medians = sorted(((median_ms(values), module)
+                      for module, values in samples.items()),
+                     reverse=True)
+    return {module: ms for ms, module in medians[:args.top]}
+
+  return {
+      'generated_at': datetime.now().isoformat(timespec='seconds'),
+      'commit': git_commit(),
+      'python': platform.python_version(),
+      'runs': args.runs,
+      'first_request_status': sorted(statuses),
+      'process_ms': round(statistics.median(walls), 3),
+      'import_app_ms': round(statistics.median(import_ms), 3),
+      'first_request_ms': round(statistics.median(first_request_ms), 3),
+      'direct_imports_ms': top(directs),
+      'slowest_modules_self_ms': top(selfs),
+  }
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--top',
+                      type=int,
+                      default=15,
+                      help='modules listed per ranking')
+  parser.add_argument('--output',
+                      default='startup-results.json',
+                      help='where to write the JSON report')
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  args = parse_args(argv)
+  report = run(args)
+  with open(args.output, 'w') as f:
+    json.dump(report, f, indent=2)
+  print(
+      f"process {report['process_ms']} ms, import app "
+      f"{report['import_app_ms']} ms, first request "
+      f"{report['first_request_ms']} ms",
+      file=sys.stderr)
+  print(f"Wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()